@@ -1,116 +1,289 @@
-import sys,os, random
+import sys,os, random, csv, gzip, bz2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from decimal import Decimal
 
-def getInputFiles(inputDIR):
+def readSampleFile(filePath):
+    # Lines of a sample file after its header, read whole from plain, gzip (.gz) or bz2 (.bz2) files, and the sample
+    # names found in its last column in order of appearance
+    if filePath.endswith('.gz'):
+        sampleFile = gzip.open(filePath, 'rt')
+    elif filePath.endswith('.bz2'):
+        sampleFile = bz2.open(filePath, 'rt')
+    else:
+        sampleFile = open(filePath)
+
+    with sampleFile:
+        sampleFile.readline()
+        data = sampleFile.read()
+    if len(data) == 0:
+        return data, []
+    if not data.endswith('\n'):
+        data += '\n'
+
+    # A sample file usually holds a single sample, whose name then ends every line
+    lastLine = data[data.rfind('\n', 0, len(data) - 1) + 1:]
+    sampleName = lastLine[lastLine.rfind('\t') + 1:-1]
+    if data.count('\t' + sampleName + '\n') == data.count('\n'):
+        return data, [sampleName]
+
+    return data, list(dict.fromkeys([fLine[fLine.rfind('\t') + 1:] for fLine in data.split('\n')[:-1]]))
+
+def getInputFiles(inputDIR, numWorkers=8):
     subDIRList = [f.path for f in os.scandir(inputDIR) if f.is_dir()]
     allID = {}
     label = None
 
-    with open("trainingData.txt", "w") as p:
-        for folderPath in subDIRList:
-            if ("Cancer" in folderPath):
-                label = 1
-            elif ("Control" in folderPath):
-                label = 0
-
-            for filename in os.listdir(folderPath):
-                file = open(folderPath + "/" + filename)
-                for fLine in file.readlines()[1:]:
-                    p.write(fLine)
-
-                    lineArr = list(fLine.split('\t'))
-                    if lineArr[-1] not in allID:
-                        allID[lineArr[-1].rstrip("\n")] = label
-    p.close()
+    # Sample files with the label of their folder, in the order they are concatenated
+    sampleFiles = []
+    for folderPath in subDIRList:
+        if ("Cancer" in folderPath):
+            label = 1
+        elif ("Control" in folderPath):
+            label = 0
+
+        for filename in os.listdir(folderPath):
+            sampleFiles.append((folderPath + "/" + filename, label))
+
+    # Sample files are read by a thread pool a few files ahead of the one being written
+    with open("trainingData.txt", "w", buffering=1<<20) as p, ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        pending = deque()
+
+        def writeNext():
+            future, sampleLabel = pending.popleft()
+            data, sampleNames = future.result()
+            p.write(data)
+            for sampleName in sampleNames:
+                allID[sampleName] = sampleLabel
+
+        for filePath, label in sampleFiles:
+            pending.append((executor.submit(readSampleFile, filePath), label))
+            if len(pending) > 2 * numWorkers:
+                writeNext()
+        while len(pending) > 0:
+            writeNext()
 
     labelsDict = {"Sample": list(allID.keys()), "Benign/Malignant": list(allID.values())}
     labels_df = pd.DataFrame.from_dict(labelsDict)
     labels_df.to_csv("labels.csv", index=False)
 
-def runGIANA(inputFilename):
-    os.system("python GIANA4.py -f " + inputFilename + " -b -S 3.3 -N 32")
-
-def getClusterComposition(clusterFilename, labelsFilename):
-    allID = pd.read_csv(labelsFilename, header=None, index_col=0, squeeze=True).to_dict()
+def runGIANA(inputFilename, labelsFilename="labels.csv", writeOutput=True):
+    # Clusters the input file with GIANA in this process and returns the result as a ClusterTable, labelled when the labels CSV exists.
+    # With writeOutput, the cluster file and its .npz columns are also written, and with the labels CSV the per-cluster
+    # composition used by getClusterComposition()
+    import GIANA4
+
+    hasLabels = os.path.exists(labelsFilename)
+    clusterFilename = GIANA4.ClusterOutputFile(inputFilename, ".") if writeOutput else ""
+    seqs, _, infos = GIANA4.ReadRepertoire(inputFilename)
+    VIndex, VCompat = GIANA4.LoadVgeneCompatibility("Imgt_Human_TRBV.fasta", 3.7)
+    # The cluster composition is only needed for the file written next to the cluster file
+    sampleLabels = GIANA4.LoadSampleLabels(labelsFilename) if hasLabels and writeOutput else None
+
+    columns = GIANA4.ClusterRepertoire(seqs, infos, outfile=clusterFilename, source=inputFilename, thr_iso=7.0, thr_s=3.3, verbose=True,
+                                       VIndex=VIndex, VCompat=VCompat, columnar=True, sampleLabels=sampleLabels, nThreads=32)
+    return ClusterTable(clusterFilename, labelsFilename if hasLabels else None, columns=columns)
+
+def loadClusterColumns(clusterFilename, keys):
+    # Columns keys of the .npz file GIANA writes next to the cluster file with -C, or None if it is missing or out of date.
+    # GIANA4 needs faiss and Biopython: without them the cluster file is parsed instead
+    try:
+        import GIANA4
+    except ImportError:
+        return None
+    return GIANA4.LoadClusterColumns(clusterFilename, keys)
+
+def loadClusterComposition(clusterFilename, allID):
+    # Cluster IDs, sizes and malignant counts from the .composition.npz file GIANA writes next to the cluster file with -L.
+    # None if it is missing, out of date, built with other labels than allID or has sequences from unlabelled samples
+    # GIANA4 needs faiss and Biopython: without them the summary is not used and the cluster file is parsed instead
+    try:
+        import GIANA4
+    except ImportError:
+        return None
+
+    composition = GIANA4.LoadClusterComposition(clusterFilename)
+    if composition is None:
+        return None
+
+    for sampleName, label in zip(composition['samples'].tolist(), composition['sampleLabels'].tolist()):
+        if sampleName not in allID or int(allID[sampleName]) != label:
+            return None
+    if composition['unlabelled'].sum() > 0:
+        return None
+
+    clusterIDs = [str(clusterID) for clusterID in composition['cluster'].tolist()]
+    return clusterIDs, composition['size'].tolist(), (composition['counts'] @ composition['labels']).tolist()
+
+def loadLabels(labelsFilename):
+    # Sample names of the labels CSV with their label (1 malignant, 0 benign)
+    return pd.read_csv(labelsFilename, header=None, index_col=0).iloc[:, 0].to_dict()
+
+def readClusterFile(clusterFilename):
+    # CDR3, cluster ID and sample columns of the cluster file in a single read, skipping the ## header lines
+    numHeader = 0
+    numColumns = 0
+    with open(clusterFilename) as clusterFile:
+        for fLine in clusterFile:
+            if ('\t' in fLine):
+                numColumns = len(fLine.split('\t'))
+                break
+            numHeader += 1
+
+    if numColumns == 0:
+        return np.array([], dtype=bytes), np.array([], dtype=np.int64), [], np.array([], dtype=np.int64)
+
+    table = pd.read_csv(clusterFilename, sep='\t', header=None, skiprows=numHeader, usecols=[0, 1, numColumns - 1], dtype=str, quoting=csv.QUOTE_NONE, na_filter=False)
+    samples, sampleNames = pd.factorize(table[numColumns - 1])
+    return table[0].values.astype(bytes), table[1].values.astype(np.int64), sampleNames.tolist(), samples
+
+class ClusterTable:
+    # GIANA cluster file parsed once into arrays with an entry per sequence: CDR3 (as bytes), cluster ID, CDR3 length and
+    # sample label (+1 malignant, 0 benign), along with the size and malignant count of each cluster
+    def __init__(self, clusterFilename, labelsFilename=None, columns=None):
+        self.clusterFilename = clusterFilename
+
+        # Takes the columns GIANA returned in memory, or loads the .npz columns when GIANA wrote them, or else parses the cluster file
+        if columns is None:
+            columns = loadClusterColumns(clusterFilename, ['CDR3', 'cluster', 'length', 'sample', 'sample_values'])
+        if columns is not None:
+            self.sequences = np.array(columns['CDR3'], dtype=bytes)
+            self.clusterIDs = columns['cluster'].astype(np.int64)
+            self.lengths = columns['length'].astype(np.int16)
+            self.sampleNames = columns['sample_values'].tolist()
+            self.samples = columns['sample']
+        else:
+            self.sequences, self.clusterIDs, self.sampleNames, self.samples = readClusterFile(clusterFilename)
+            self.lengths = np.char.str_len(self.sequences).astype(np.int16)
+
+        # Cluster IDs in order of first appearance and the index of the cluster of each sequence
+        clusters, first, inverse = np.unique(self.clusterIDs, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.clusters = clusters[order]
+        self.clusterIndex = rank[inverse.reshape(-1)]
+        self.sizes = np.bincount(self.clusterIndex, minlength=len(self.clusters))
+
+        self.labels = None
+        self.malignant = None
+        self.availableGrid = None
+        if labelsFilename != None:
+            allID = loadLabels(labelsFilename)
+            self.labels = np.array([int(allID[sampleName]) for sampleName in self.sampleNames], dtype=np.int8)[self.samples]
+            self.malignant = np.bincount(self.clusterIndex, weights=self.labels, minlength=len(self.clusters)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.clusterIDs)
+
+    def getSequences(self, mask):
+        return self.sequences[mask].astype(str).tolist()
+
+    def selectClusters(self, userSize, userPurity, clusterSizeDict=None, clusterPurityDict=None):
+        # Masks of the sequences in malignant and healthy clusters of at most userSize sequences, using the sizes and
+        # malignant counts of the table or those of the given dictionaries (clusters missing from them are left out)
+        if clusterSizeDict == None:
+            known = np.ones(len(self.clusters), dtype=bool)
+            sizes = self.sizes.astype(np.float64)
+            purities = self.malignant / sizes
+        else:
+            clusterIDs = [str(clusterID) for clusterID in self.clusters.tolist()]
+            known = np.array([clusterID in clusterPurityDict for clusterID in clusterIDs], dtype=bool)
+            sizes = np.array([clusterSizeDict.get(clusterID, 1) for clusterID in clusterIDs], dtype=np.float64)
+            purities = np.array([clusterPurityDict.get(clusterID, 0) for clusterID in clusterIDs], dtype=np.float64) / sizes
+
+        selected = known & (sizes <= userSize)
+        malignant = selected & (purities >= userPurity)
+        healthy = selected & ~malignant & (purities <= float(Decimal('1')-Decimal(str(userPurity))))
+        return malignant[self.clusterIndex], healthy[self.clusterIndex]
+
+    def buildAvailableGrid(self):
+        # Cumulative counts of sequences of length 12 to 17 over the distinct cluster sizes and purities: grid[i, j] counts
+        # those in clusters with one of the i smallest sizes and one of the j lowest purities
+        inLength = (self.lengths >= 12) & (self.lengths <= 17)
+        counts = np.bincount(self.clusterIndex, weights=inLength, minlength=len(self.clusters)).astype(np.int64)
+        gridSizes, sizeRank = np.unique(self.sizes, return_inverse=True)
+        gridPurities, purityRank = np.unique(self.malignant / self.sizes.astype(np.float64), return_inverse=True)
+
+        grid = np.zeros((len(gridSizes) + 1, len(gridPurities) + 1), dtype=np.int64)
+        np.add.at(grid, (sizeRank.reshape(-1) + 1, purityRank.reshape(-1) + 1), counts)
+        self.availableGrid = (gridSizes, gridPurities, grid.cumsum(axis=0).cumsum(axis=1))
+
+    def countAvailableSeq(self, userSize, userPurity):
+        # Number of sequences separateClusters() returns for the given thresholds, which can also be arrays of thresholds
+        if self.availableGrid is None:
+            self.buildAvailableGrid()
+        gridSizes, gridPurities, grid = self.availableGrid
+
+        userSize, userPurity = np.broadcast_arrays(np.asarray(userSize), np.asarray(userPurity, dtype=np.float64))
+        purities, purityInverse = np.unique(userPurity, return_inverse=True)
+        healthyPurity = np.array([float(Decimal('1')-Decimal(str(purity))) for purity in purities.tolist()])[purityInverse.reshape(userPurity.shape)]
+        sizeIndex = np.searchsorted(gridSizes, userSize, side='right')
+        purityIndex = np.searchsorted(gridPurities, userPurity, side='left')
+
+        # Malignant clusters have at least userPurity, healthy ones the others up to 1-userPurity
+        cancer = grid[sizeIndex, -1] - grid[sizeIndex, purityIndex]
+        noncancer = grid[sizeIndex, np.minimum(purityIndex, np.searchsorted(gridPurities, healthyPurity, side='right'))]
+        return cancer + noncancer
+
+def loadClusterTable(clusterTable, labelsFilename=None):
+    # Cluster functions take a ClusterTable or the name of a cluster file to build one from
+    if isinstance(clusterTable, ClusterTable):
+        return clusterTable
+    return ClusterTable(clusterTable, labelsFilename)
+
+def getClusterComposition(clusterTable, labelsFilename=None):
     # clusterPurityDict stores value (+1 malignant, +0 benign) for all seq. in a cluster
-    clusterPurityDict = {}
     # clusterSizeDict stores total number of sequences in a cluster
-    clusterSizeDict = {}
-
-    # Collects information about size and purity for each cluster
-    clusterFile = open(clusterFilename)
-    
-    for fLine in clusterFile.readlines()[1:]:
-        lineArr = list(fLine.split('\t'))
-        sampleName = lineArr[-1].rstrip("\n")
-
-        if (len(lineArr) > 1):
-            clusterID = lineArr[1]
 
-            if (clusterID not in clusterPurityDict):
-                clusterPurityDict[clusterID] = 0
-                clusterSizeDict[clusterID] = 0
+    # Given a cluster file, uses the summary GIANA wrote when it is available
+    if not isinstance(clusterTable, ClusterTable):
+        composition = loadClusterComposition(clusterTable, loadLabels(labelsFilename))
+        if composition is not None:
+            clusterIDs, sizes, purities = composition
+            return dict(zip(clusterIDs, sizes)), dict(zip(clusterIDs, purities))
 
-            clusterPurityDict[clusterID] += int(allID[sampleName])
-            clusterSizeDict[clusterID] += 1
+    clusterTable = loadClusterTable(clusterTable, labelsFilename)
+    clusterIDs = [str(clusterID) for clusterID in clusterTable.clusters.tolist()]
+    clusterSizeDict = dict(zip(clusterIDs, clusterTable.sizes.tolist()))
+    clusterPurityDict = dict(zip(clusterIDs, clusterTable.malignant.tolist()))
 
     return clusterSizeDict, clusterPurityDict
 
-def separateClusters(clusterFilename, clusterSizeDict, clusterPurityDict, userSize=None, userPurity=None):
+def separateClusters(clusterTable, clusterSizeDict=None, clusterPurityDict=None, userSize=None, userPurity=None):
     if userSize == None:
         userSize = 50
     if userPurity == None:
         userPurity = 0.8
 
-    clusterFile = open(clusterFilename)
-    cancer = 0
-    noncancer = 0
-    availableSeq = 0
-
     # Separates sequences by length and type
-    cancerDict = {'cl12':[], 'cl13':[], 'cl14':[], 'cl15':[], 'cl16':[], 'cl17':[]}
-    nonCancerDict = {'nl12':[], 'nl13':[], 'nl14':[], 'nl15':[], 'nl16':[], 'nl17':[]}
-
-    # Filters clusters by size and purity
-    clusterFile.seek(0)
-    for fLine in clusterFile.readlines():
-        lineArr = list(fLine.split('\t'))
-
-        if (len(lineArr) > 1 and lineArr[1] in clusterPurityDict):
-            seq = lineArr[0]
-            clusterID = lineArr[1]
-
-            if (clusterSizeDict[clusterID] <= userSize):
-                # Purity is calculated by the % of seq in a cluster that belong to healthy/cancer patients
-                purity = clusterPurityDict[clusterID]/clusterSizeDict[clusterID]
-
-                # Classify clusters as malignant
-                if (purity >= userPurity):
-                    if ('cl' + str(len(seq)) in cancerDict):
-                        cancerDict['cl' + str(len(seq))].append(seq)
-                        cancer += 1
-                        availableSeq += 1
-
-                # Classify clusters as healthy
-                elif (purity <= float(Decimal('1')-Decimal(str(userPurity)))):
-                    if ('nl' + str(len(seq)) in nonCancerDict):
-                        nonCancerDict['nl' + str(len(seq))].append(seq)
-                        noncancer += 1
-                        availableSeq += 1
+    cancerDict = {}
+    nonCancerDict = {}
+
+    # Purity is calculated by the % of seq in a cluster that belong to healthy/cancer patients
+    clusterTable = loadClusterTable(clusterTable)
+    malignant, healthy = clusterTable.selectClusters(userSize, userPurity, clusterSizeDict, clusterPurityDict)
+    for length in range(12, 18):
+        cancerDict['cl' + str(length)] = clusterTable.getSequences(malignant & (clusterTable.lengths == length))
+        nonCancerDict['nl' + str(length)] = clusterTable.getSequences(healthy & (clusterTable.lengths == length))
+
+    cancer = sum([len(seqs) for seqs in cancerDict.values()])
+    noncancer = sum([len(seqs) for seqs in nonCancerDict.values()])
+    availableSeq = cancer + noncancer
 
     return cancerDict, nonCancerDict, availableSeq
 
-def getTrainingandValidation(clusterFilename, labelsFilename, userSize=None, userPurity=None):
+def getTrainingandValidation(clusterTable, labelsFilename=None, userSize=None, userPurity=None):
     if userSize == None:
         userSize = 50
     if userPurity == None:
         userPurity = 0.8
 
-    clusterSizeDict, clusterPurityDict = getClusterComposition(clusterFilename, labelsFilename)
-    cancerDict, nonCancerDict, availableSeq = separateClusters(clusterFilename, clusterSizeDict, clusterPurityDict, userSize, userPurity)
+    clusterTable = loadClusterTable(clusterTable, labelsFilename)
+    cancerDict, nonCancerDict, availableSeq = separateClusters(clusterTable, userSize=userSize, userPurity=userPurity)
     outDIR = "DeepCATInput"
 
     # Shuffle and distribute sequences for training and validations via 80/20 split
@@ -162,20 +335,19 @@ def runAutoCAT(inputDIR, userSize=None, userPurity=None):
     if userPurity == None:
         userPurity = 0.8
 
+    # Clusters are passed on in memory, without writing and parsing back the cluster file
     getInputFiles(inputDIR)
-    runGIANA("trainingData.txt")
-    getTrainingandValidation("trainingData--RotationEncodingBL62.txt", "labels.csv", userSize, userPurity)
+    clusterTable = runGIANA("trainingData.txt", "labels.csv", writeOutput=False)
+    getTrainingandValidation(clusterTable, userSize=userSize, userPurity=userPurity)
 
-def graphAvailableSeq(clusterFilename, labelsFilename):
+def graphAvailableSeq(clusterTable, labelsFilename=None):
     availSeq = {0.6:[], 0.7:[], 0.8:[], 0.9:[], 1:[]}
     allSizes = [10, 50, 100, 200, 500]
 
-    clusterPurityDict, clusterSizeDict = getClusterComposition(clusterFilename, labelsFilename)
+    clusterTable = loadClusterTable(clusterTable, labelsFilename)
 
-    for size in allSizes:
-        for purity in availSeq.keys():
-            _, __, availableSeq = separateClusters(clusterFilename, clusterPurityDict, clusterSizeDict, size, purity)
-            availSeq[purity].append(availableSeq)
+    for purity in availSeq.keys():
+        availSeq[purity] = clusterTable.countAvailableSeq(allSizes, purity).tolist()
 
     fig, ax = plt.subplots()
     plt.rcParams["figure.figsize"] = (10,10)
@@ -198,27 +370,43 @@ def graphAvailableSeq(clusterFilename, labelsFilename):
 
     plt.savefig("graphAvailableSequences.png", bbox_inches='tight')
 
-def graphSamplePurity(clusterFilename, labelsFilename, userSize=None):
+def getPurityStats(clusterTable, labelsFilename=None, purities=None, userSize=None):
+    if purities is None:
+        purities = [0.6, 0.7, 0.8, 0.9]
+
+    clusterTable = loadClusterTable(clusterTable, labelsFilename)
+    sizes = clusterTable.sizes
+    malignant = clusterTable.malignant
+    if userSize != None:
+        sizes, malignant = sizes[sizes <= userSize], malignant[sizes <= userSize]
+
+    # Sequences derived from noncancer and cancer samples, accumulated over clusters in order of purity
+    clusterPurities = malignant / sizes.astype(np.float64)
+    order = np.argsort(clusterPurities, kind='stable')
+    clusterPurities = clusterPurities[order]
+    fromNonCancer = np.concatenate([[0], np.cumsum((sizes - malignant)[order])])
+    fromCancer = np.concatenate([[0], np.cumsum(malignant[order])])
 
-    clusterSizeDict, clusterPurityDict = getClusterComposition(clusterFilename, labelsFilename)
+    # Clusters are classified as cancer from the purity cutoff up and as noncancer from 1-cutoff down
+    purities = np.asarray(purities, dtype=np.float64)
+    cancerIndex = np.searchsorted(clusterPurities, purities, side='left')
+    nonCancerPurities = np.array([float(Decimal('1')-Decimal(str(purity))) for purity in purities.tolist()])
+    nonCancerIndex = np.minimum(cancerIndex, np.searchsorted(clusterPurities, nonCancerPurities, side='right'))
 
-    # [derived from noncancer, derived from cancer]
-    cancerPurityDict = {0.6: [0, 0], 0.7: [0, 0], 0.8: [0, 0], 0.9: [0, 0]}
-    nonCancerPurityDict = {0.6: [0, 0], 0.7: [0, 0], 0.8: [0, 0], 0.9: [0, 0]}
+    purityStats = pd.DataFrame({'cancerFromNonCancer': fromNonCancer[-1] - fromNonCancer[cancerIndex],
+                                'cancerFromCancer': fromCancer[-1] - fromCancer[cancerIndex],
+                                'nonCancerFromNonCancer': fromNonCancer[nonCancerIndex],
+                                'nonCancerFromCancer': fromCancer[nonCancerIndex]}, index=pd.Index(purities, name='purity'))
 
-    for purity in cancerPurityDict:
-        for clusterID in clusterPurityDict:
-            if (userSize == None or clusterSizeDict[clusterID] <= userSize):
-                clusterPurity = clusterPurityDict[clusterID]/clusterSizeDict[clusterID]
+    # TCR classification error is the fraction of noncancer-derived sequences classified as cancer
+    with np.errstate(divide='ignore', invalid='ignore'):
+        purityStats['tcrError'] = purityStats['cancerFromNonCancer'] / (purityStats['cancerFromNonCancer'] + purityStats['nonCancerFromNonCancer'])
 
-                if (clusterPurity >= purity):
-                    cancerPurityDict[purity][0] += clusterSizeDict[clusterID]-clusterPurityDict[clusterID]
-                    cancerPurityDict[purity][1] += clusterPurityDict[clusterID]
+    return purityStats
 
-                elif (clusterPurity <= float(Decimal('1')-Decimal(str(purity)))):
-                    nonCancerPurityDict[purity][0] += clusterSizeDict[clusterID] - clusterPurityDict[clusterID]
-                    nonCancerPurityDict[purity][1] += clusterPurityDict[clusterID]
+def graphSamplePurity(clusterTable, labelsFilename=None, userSize=None):
 
+    purityStats = getPurityStats(clusterTable, labelsFilename, userSize=userSize)
 
     #Bar Graph
     cacData = {"Derived from\nCancer": [], "Derived from\nNonCancer": []}
@@ -227,13 +415,15 @@ def graphSamplePurity(clusterFilename, labelsFilename, userSize=None):
     # TCR Classification Error
     tcrError = {}
 
-    for p in cancerPurityDict:
-        cacData["Derived from\nCancer"].append( int(round(cancerPurityDict[p][1] / sum(cancerPurityDict[p]), 2) * 100))
-        cacData["Derived from\nNonCancer"].append( int(round(cancerPurityDict[p][0] / sum(cancerPurityDict[p]), 2) * 100))
-        cancData["Derived from\nCancer"].append( int(round(nonCancerPurityDict[p][1] / sum(nonCancerPurityDict[p]), 2) * 100))
-        cancData["Derived from\nNonCancer"].append( int(round(nonCancerPurityDict[p][0] / sum(nonCancerPurityDict[p]), 2) * 100))
+    for p, stats in zip(purityStats.index.tolist(), purityStats.to_dict('records')):
+        cancerTotal = stats['cancerFromCancer'] + stats['cancerFromNonCancer']
+        nonCancerTotal = stats['nonCancerFromCancer'] + stats['nonCancerFromNonCancer']
+        cacData["Derived from\nCancer"].append( int(round(stats['cancerFromCancer'] / cancerTotal, 2) * 100))
+        cacData["Derived from\nNonCancer"].append( int(round(stats['cancerFromNonCancer'] / cancerTotal, 2) * 100))
+        cancData["Derived from\nCancer"].append( int(round(stats['nonCancerFromCancer'] / nonCancerTotal, 2) * 100))
+        cancData["Derived from\nNonCancer"].append( int(round(stats['nonCancerFromNonCancer'] / nonCancerTotal, 2) * 100))
 
-        tcrError[str(int(p * 100))+"%"] = int(round(cancerPurityDict[p][0]/(cancerPurityDict[p][0] + nonCancerPurityDict[p][0]), 2) *100)
+        tcrError[str(int(p * 100))+"%"] = int(round(stats['tcrError'], 2) *100)
     
     # print (tcrError)
     fig = plt.figure()
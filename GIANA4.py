@@ -21,26 +21,43 @@
 ## Aug 24, 2020: Add GPU option
 ## Sep 26, 2020: Find a bug in identical CDR3 handling when V genes are different
 
-import sys, os, re, resource
+import sys, os, re, csv, resource, hashlib, tempfile, shutil, gc, threading, queue, fcntl
 from os import path
 import numpy as np
 from Bio.SubsMat.MatrixInfo import blosum62
 import time
 from time import gmtime, strftime
 from operator import itemgetter
-from itertools import chain
+from itertools import chain, combinations, islice
 from random import shuffle
 from optparse import OptionParser
 from collections import Counter
+from multiprocessing import Pool
 from sklearn.decomposition import PCA
+from sklearn.metrics import adjusted_rand_score
 from sklearn.manifold import MDS
 import faiss
-from query import *
 
 AAstring='ACDEFGHIKLMNPQRSTVWY'
 AAstringList=list(AAstring)
+AAset=set(AAstring)
 cur_dir=os.path.dirname(os.path.realpath(__file__))+'/'
 
+## Approximate nearest neighbor backends for ClusterCDR3. Buckets smaller than ANNMinSize always use the exact flat index.
+IndexTypes=['flat','ivf','hnsw']
+ANNMinSize=5000
+IVFnprobe=16
+HNSWm=32
+HNSWefSearch=64
+## Compression of the encoding vectors: pca projects them to PCADim dimensions before clustering, sq8 and pq store
+## them in the faiss index as 8-bit scalar quantized or PQm byte product quantized codes. Buckets smaller than
+## ANNMinSize are not quantized.
+Compressions=['none','pca','sq8','pq']
+PCADim=64
+PQm=24
+## Length buckets with at least MmapMinSize CDR3s use memory-mapped encoding matrices and merge buffers when a directory is given
+MmapMinSize=100000
+
 blosum62n={}
 for kk in blosum62:
     a1=kk[0]
@@ -91,6 +108,9 @@ for ii in range(len(AAstringList)):
     aa=AAstringList[ii]
     CODE=[0]*(ii)+[1]+[0]*(20-ii)
     AAencodingDict[aa]=np.array(CODE)
+## ASCII code -> True for the amino acid letters accepted in CDR3s
+AAvalid=np.zeros(256, dtype=bool)
+AAvalid[[ord(x) for x in AAencodingDict]]=True
 
 Ndim=16  ## optimized for isometric embedding
 n0=Ndim*6
@@ -196,95 +216,298 @@ def EncodingCDR3(s, M, n0):
         x = np.dot(M, (x+bl62np[sL[ii]]))
     return x
 
+## Residue index lookup (ASCII code -> row of bl62npM) used by the batch encoder
+AAindex=np.full(256, 255, dtype=np.uint8)
+for ii in range(20):
+    AAindex[ord(vkk[ii])]=ii
+bl62npM=np.array([bl62np[kk] for kk in vkk])
+
+def CDR3toArray(seqs, lookup=AAindex):
+    ## Convert a list of equal-length CDR3s into a fixed-width uint8 residue index matrix
+    ## lookup: ASCII code -> residue index table, 255 for letters outside its alphabet
+    N=len(seqs)
+    if N==0:
+        return np.zeros((0,0), dtype=np.uint8)
+    L=len(seqs[0])
+    buf=np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    if buf.shape[0] != N*L:
+        raise ValueError("CDR3toArray requires CDR3s of equal length")
+    aM=lookup[buf].reshape(N, L)
+    if (aM==255).any():
+        raise ValueError("CDR3 contains a letter outside the encoding alphabet")
+    return aM
+
+## Number of CDR3s encoded at a time by EncodingCDR3Batch and memory-mapped EncodeCDR3List
+EncodeBlockSize=65536
+
+def EncodingCDR3Batch(seqs, M, n0):
+    ## Batch version of EncodingCDR3: returns the float32 N x n0 encoding matrix of a list of CDR3s
+    ## EncodingCDR3 computes x = sum_i M^(L-i) * b(s_i), so each position i contributes one row of
+    ## a precomputed 20 x n0 table. Rows are summed in the same order as EncodingCDR3, so for the
+    ## permutation matrix M6 the result is bit-identical.
+    N=len(seqs)
+    dM=np.zeros((N, n0), dtype="float32")
+    if N==0:
+        return dM
+    LL=np.array([len(x) for x in seqs])
+    for L in np.unique(LL):
+        idx=np.where(LL==L)[0]
+        if L==0:
+            continue
+        aM=CDR3toArray([seqs[x] for x in idx])
+        ## powM[k]=M^(k+1)
+        powM=[M]
+        for kk in range(1, L):
+            powM.append(np.dot(M, powM[kk-1]))
+        tabs=[np.dot(bl62npM, powM[L-ii-1].T) for ii in range(L)]
+        ## float64 sums are taken in blocks of rows to bound the temporary array
+        for a in range(0, len(idx), EncodeBlockSize):
+            b=min(a+EncodeBlockSize, len(idx))
+            x=np.zeros((b-a, n0))
+            for ii in range(L):
+                x+=tabs[ii][aM[a:b,ii]]
+            dM[idx[a:b],]=x
+    return dM
+
+## Version tag of the V gene score table computation; any change to VgeneScoreTable invalidates cached tables
+VgeneScoreVersion='1'
+
+## Version tag of the rotation encoding; any change to M6 or the amino acid embedding invalidates stored vectors
+EncodingVersion=hashlib.md5(M6.tobytes()+bl62npM.tobytes()).hexdigest()
+
+class EmbeddingStore:
+    ## Persistent, append-only store of encoded CDR3s, keyed by the full CDR3 sequence
+    ## Layout of the store directory:
+    ##   meta.txt:        ST, n0 and encoding version used to build the store
+    ##   keys.txt:        one CDR3 per line, line number is the row in vectors.f32
+    ##   vectors.f32:     float32 matrix (number of keys x n0), memory-mapped for lookup
+    ##   stats.txt:       number of CDR3s encoded and seconds spent encoding them, used to estimate time saved
+    ##   lock:            file locked exclusively while the store is opened or appended to, so several processes can share it.
+    ##                    Keys appended by other processes are picked up before each append.
+    def __init__(self, dbDir, ST=3, n0=n0):
+        self.dir=dbDir
+        self.ST=ST
+        self.n0=n0
+        self.hits=0
+        self.misses=0
+        self.n_encode=0
+        self.t_encode=0
+        self.t_lookup=0
+        if not os.path.exists(dbDir):
+            os.makedirs(dbDir)
+        self.metaFile=dbDir+'/meta.txt'
+        self.keyFile=dbDir+'/keys.txt'
+        self.vecFile=dbDir+'/vectors.f32'
+        self.statFile=dbDir+'/stats.txt'
+        self.lockFile=dbDir+'/lock'
+        meta='ST='+str(ST)+'|n0='+str(n0)+'|version='+EncodingVersion
+        with self._locked():
+            meta0=''
+            if os.path.exists(self.metaFile):
+                with open(self.metaFile) as h:
+                    meta0=h.read().strip()
+            if meta0==meta:
+                self.n_encode, self.t_encode = self._readStats()
+            else:
+                if os.path.exists(self.metaFile):
+                    print('Embedding store '+dbDir+' was built with different parameters. Rebuilding.')
+                with open(self.keyFile,'w') as h:
+                    pass
+                with open(self.vecFile,'w') as h:
+                    pass
+                if os.path.exists(self.statFile):
+                    os.remove(self.statFile)
+                with open(self.metaFile,'w') as h:
+                    h.write(meta+'\n')
+            self.KD={}
+            ## Rows of vectors.f32 and bytes of keys.txt read into KD
+            self.nRows=0
+            self.keyOffset=0
+            self._sync()
+        self._map()
+    def _locked(self):
+        ## Open the lock file and take an exclusive lock on the store, released when the returned file is closed
+        h=open(self.lockFile,'a')
+        fcntl.flock(h, fcntl.LOCK_EX)
+        return h
+    def _sync(self):
+        ## With the lock held: add the keys appended to the store since the last sync to KD
+        ## An interrupted append may leave keys and vectors out of step: the store is cut back to the common part
+        with open(self.keyFile,'ab+') as h:
+            h.seek(self.keyOffset)
+            data=h.read()
+        vsize=os.path.getsize(self.vecFile) if os.path.exists(self.vecFile) else 0
+        nn=vsize//(4*self.n0)
+        newKeys=data.split(b'\n')[:-1][:max(nn-self.nRows, 0)]
+        for x in newKeys:
+            self.KD[x.decode()]=self.nRows
+            self.nRows+=1
+        nBytes=sum([len(x)+1 for x in newKeys])
+        self.keyOffset+=nBytes
+        if len(data)>nBytes or vsize>self.nRows*4*self.n0:
+            with open(self.keyFile,'ab') as h:
+                h.truncate(self.keyOffset)
+            with open(self.vecFile,'ab') as h:
+                h.truncate(self.nRows*4*self.n0)
+    def _readStats(self):
+        if not os.path.exists(self.statFile):
+            return 0, 0
+        with open(self.statFile) as h:
+            ww=h.read().strip().split('\t')
+        return int(ww[0]), float(ww[1])
+    def _map(self):
+        nn=self.nRows
+        if nn>0:
+            self.vectors=np.memmap(self.vecFile, dtype='float32', mode='r', shape=(nn, self.n0))
+        else:
+            self.vectors=np.zeros((0, self.n0), dtype='float32')
+    def Encode(self, seqs):
+        ## Return the float32 encoding matrix of seqs, encoding and appending only unseen CDR3s
+        ST=self.ST
+        t1=time.time()
+        rows=np.array([self.KD.get(x, -1) for x in seqs], dtype=np.int64)
+        hit=np.where(rows>=0)[0]
+        miss=np.where(rows<0)[0]
+        self.hits+=len(hit)
+        self.misses+=len(miss)
+        dM=np.zeros((len(seqs), self.n0), dtype='float32')
+        if len(hit)>0:
+            dM[hit,]=self.vectors[rows[hit],]
+        self.t_lookup+=time.time()-t1
+        if len(miss)>0:
+            t1=time.time()
+            dM[miss,]=EncodingCDR3Batch([seqs[x][ST:-2] for x in miss], M6, self.n0)
+            t_miss=time.time()-t1
+            with self._locked():
+                ## Rows are numbered after those on disk, which include the appends of other processes
+                self._sync()
+                start=os.path.getsize(self.vecFile)//(4*self.n0)
+                newKeys=[]
+                newRows=[]
+                for ii in miss:
+                    ss=seqs[ii]
+                    if ss in self.KD:
+                        continue
+                    self.KD[ss]=start+len(newKeys)
+                    newKeys.append(ss)
+                    newRows.append(ii)
+                with open(self.vecFile,'ab') as h:
+                    h.write(dM[newRows,].tobytes())
+                keyData=''.join([x+'\n' for x in newKeys]).encode()
+                with open(self.keyFile,'ab') as h:
+                    h.write(keyData)
+                self.nRows=start+len(newKeys)
+                self.keyOffset+=len(keyData)
+                n_encode, t_encode = self._readStats()
+                self.n_encode=n_encode+len(miss)
+                self.t_encode=t_encode+t_miss
+                with open(self.statFile,'w') as h:
+                    h.write(str(self.n_encode)+'\t'+str(self.t_encode)+'\n')
+            self._map()
+        return dM
+    def Report(self):
+        ## Hit/miss counters; saved time is estimated from the average encoding time recorded in the store
+        nn=self.hits+self.misses
+        rate=self.hits/nn if nn>0 else 0
+        saved=self.t_encode/self.n_encode*self.hits-self.t_lookup if self.n_encode>0 else 0
+        print("Embedding store %s: %d hits, %d misses (hit rate %.3f), %d CDR3s stored, estimated time saved %f" %(self.dir, self.hits, self.misses, rate, len(self.KD), saved))
+
+def MmapBuffer(shape, mmapDir):
+    ## float32 array backed by a temporary file in mmapDir. The file is unlinked at once and freed when the array is released
+    fd, fname=tempfile.mkstemp(dir=mmapDir, suffix='.f32')
+    os.close(fd)
+    buf=np.memmap(fname, dtype='float32', mode='w+', shape=shape)
+    os.remove(fname)
+    return buf
+
+def EncodeCDR3List(vss, ST=3, eStore=None, mmapDir=None):
+    ## Encode a length bucket, through the embedding store if one is given
+    ## mmapDir: if given, the matrix is a memory-mapped float32 file there, filled in blocks of EncodeBlockSize CDR3s
+    if mmapDir is not None:
+        dM=MmapBuffer((len(vss), n0), mmapDir)
+        for a in range(0, len(vss), EncodeBlockSize):
+            b=min(a+EncodeBlockSize, len(vss))
+            dM[a:b]=EncodeCDR3List(vss[a:b], ST, eStore)
+        return dM
+    if eStore is not None:
+        return eStore.Encode(vss)
+    return EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+
 def BuildLengthDict(seqs, sIDs, vGene=[], INFO=[]):
-    LLs=[10,11,12,13,14,15,16,17,18,19,20,21,22,23,24]
+    ## Bucket CDR3s of length 10 to 24 by length, skipping CDR3s with letters outside the amino acid alphabet
+    ## Buckets are in order of first appearance of each length and keep the input order.
+    ## Letters are checked on a single byte array of all CDR3s.
     LengthD={}
     SeqD={}
     VgeneD={}
     InfoD={}
-    AAs=set(list(AAencodingDict.keys()))
-    NAs=len(AAencodingDict)
-    cNAs=0
-    for ii in range(len(seqs)):
-        ID=sIDs[ii]
-        ss=seqs[ii]
-        ssAA=set(list(ss))
-        TMP=list(ssAA | AAs)
-        if len(TMP) > NAs:
-            ## CDR3 containing non amino acid letter
-            #print('Warning: CDR3: '+ss + ' contains non amino acid letter!')
-            cNAs+=1
-            continue
+    N=len(seqs)
+    LL=np.fromiter(map(len, seqs), dtype=np.int64, count=N)
+    buf=np.frombuffer(''.join(seqs).encode('utf-8'), dtype=np.uint8)
+    if buf.shape[0]==LL.sum():
+        ## number of invalid letters of each CDR3 from the cumulative count over the byte array
+        cBad=np.zeros(buf.shape[0]+1, dtype=np.int64)
+        np.cumsum(~AAvalid[buf], out=cBad[1:])
+        ends=np.cumsum(LL)
+        ok=cBad[ends]==cBad[ends-LL]
+    else:
+        ## non-ASCII input, checked one CDR3 at a time
+        AAs=set(list(AAencodingDict.keys()))
+        ok=np.array([set(x) <= AAs for x in seqs], dtype=bool)
+    cNAs=int(N-ok.sum())
+    idx=np.where(ok & (LL>=10) & (LL<=24))[0]
+    Lk=LL[idx]
+    uL, first=np.unique(Lk, return_index=True)
+    for L in uL[np.argsort(first)].tolist():
+        ii=idx[Lk==L].tolist()
+        LengthD[L]=[sIDs[x] for x in ii]
+        SeqD[L]=[seqs[x] for x in ii]
         if len(vGene)>0:
-            vv=vGene[ii]
+            VgeneD[L]=[vGene[x] for x in ii]
         if len(INFO)>0:
-            info=INFO[ii]
-        L=len(ss)
-        if L not in LLs:
-            continue
-        if L not in LengthD:
-            LengthD[L]=[ID]
-            SeqD[L]=[ss]
-            if len(vGene)>0:
-                VgeneD[L]=[vv]
-            if len(INFO)>0:
-                InfoD[L]=[info]
-        else:
-            LengthD[L].append(ID)
-            SeqD[L].append(ss)
-            if len(vGene)>0:
-                VgeneD[L].append(vv)
-            if len(INFO)>0:
-                InfoD[L].append(info)
+            InfoD[L]=[INFO[x] for x in ii]
     if cNAs>0:
         print("Warning: Skipped %d sequences with non AA letter!" %(cNAs))
     return LengthD, VgeneD, InfoD, SeqD
 
 def CollapseUnique(LD, VD, ID, SD):
-    kks=LD.keys()
+    ## Collapse identical (CDR3, V gene) pairs in each length bucket. Unique pairs are sorted by CDR3, then V gene;
+    ## IDu keeps the information of all collapsed copies in input order
     LDu={}
     VDu={}
     IDu={}
     SDu={}
-    for kk in kks:
-        vvL=list(LD[kk])
-        if len(VD)>0:
-            vvV=list(VD[kk])
-        else:
-            vvV=['TRBV2-1*01']*len(vvL)
-        vvI=list(ID[kk])
-        vvS=list(SD[kk])
-        zz=zip(vvL, vvS, vvV, vvI)
-        zzs=sorted(zz, key = lambda x: (x[1], x[2]))
-        nz=len(zzs)
-        pointer_pre=0
-        pointer_cur=1
-        s_pre=zzs[pointer_pre][1]
-        v_pre=zzs[pointer_pre][2]
-        uS=[s_pre]
-        uV=[v_pre]
-        uI=[[zzs[pointer_pre][3]]]
-        while pointer_cur < nz:
-            s_cur=zzs[pointer_cur][1]
-            v_cur=zzs[pointer_cur][2]
-            if s_cur == s_pre and v_cur == v_pre:
-                uI[len(uI)-1].append(zzs[pointer_cur][3])
-                pointer_cur += 1
-                continue
+    ## the many small lists built here would trigger repeated full garbage collections
+    gcOn=gc.isenabled()
+    gc.disable()
+    try:
+        for kk in LD:
+            n=len(LD[kk])
+            if len(VD)>0:
+                vvV=VD[kk]
             else:
-                uS.append(s_cur)
-                uV.append(v_cur)
-                uI.append([zzs[pointer_cur][3]])
-                s_pre=s_cur
-                v_pre=v_cur
-                pointer_pre=pointer_cur
-                pointer_cur += 1
-        uL=[x for x in range(len(uS))]
-        LDu[kk]=uL
-        SDu[kk]=uS
-        if len(VD)>0:
-            VDu[kk]=uV
-        IDu[kk]=uI
+                vvV=['TRBV2-1*01']*n
+            vvI=ID[kk]
+            Sa=np.array(SD[kk])
+            Va=np.array(vvV)
+            ## stable sort, so collapsed copies stay in input order
+            order=np.lexsort((Va, Sa))
+            Ss=Sa[order]
+            Vs=Va[order]
+            new=np.ones(n, dtype=bool)
+            new[1:]=(Ss[1:]!=Ss[:-1]) | (Vs[1:]!=Vs[:-1])
+            starts=np.where(new)[0]
+            bounds=starts.tolist()+[n]
+            order=order.tolist()
+            LDu[kk]=list(range(len(starts)))
+            SDu[kk]=Ss[starts].tolist()
+            if len(VD)>0:
+                VDu[kk]=Vs[starts].tolist()
+            vvI=[vvI[x] for x in order]
+            IDu[kk]=[vvI[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    finally:
+        if gcOn:
+            gc.enable()
     return LDu, VDu, IDu, SDu
 
 
@@ -361,25 +584,29 @@ class KmerSet:
                 kkn2=[''.join(list(x)) for x in kkn2]
                 KS_n1+=kkn2
         return KS_n1
-    def KmerIndex(self):
-        ## For each K-mer, find its nearest neighbor with 1 character mismatch
+    def KmerIndex(self, nMismatch=1):
+        ## For each K-mer, find its neighbors with up to nMismatch character mismatches
+        ## K-mers are hashed by the string left after masking nMismatch positions, so that neighbors share a bucket.
+        ## A bucket member is a neighbor if its masked characters are amino acids, as in FindKmerNeighbor(2)
         KKs=list(self.KD.keys())
         KS=self.KS
-        KKs_set=set(KKs)
-        Skk='_'.join(KKs)
-        KI_Dict={}
+        KI_Dict={kk:set() for kk in KKs}
+        for pos in combinations(range(KS), nMismatch):
+            getKey=itemgetter(*[x for x in range(KS) if x not in pos])
+            buckets={}
+            for kk in KKs:
+                key=getKey(kk)
+                if key not in buckets:
+                    buckets[key]=[kk]
+                else:
+                    buckets[key].append(kk)
+            for key in buckets:
+                vv=buckets[key]
+                vvAA=[x for x in vv if all([x[p] in AAset for p in pos])]
+                for kk in vv:
+                    KI_Dict[kk].update(vvAA)
         for kk in KKs:
-##            kk_neighbor=[]
-##            for jj in range(KS):
-##                kk_pre=kk[0:jj]
-##                kk_suf=kk[(jj+1):KS]
-##                pat=kk_pre+'['+AAstring+']{1}'+kk_suf
-##                p=re.compile(pat)
-##                mm=[m.group() for m in p.finditer(Skk)]
-##                kk_neighbor+=mm
-            KS_n=set(self.FindKmerNeighbor(kk))
-            kk_neighbor = KS_n & KKs_set
-            KI_Dict[kk]=list(kk_neighbor)
+            KI_Dict[kk]=list(KI_Dict[kk])
         return KI_Dict
     def updateKD(self, KI):
         ## group sequences sharing motifs with 1-2 mismatches
@@ -426,9 +653,9 @@ def GenerateMotifGraph(mD,seqs,seqID):
                     SeqShareGraph[id_2].append(id_1)
     return SeqShareGraph
 
-def generateSSG(Kset, CDR3s, k_thr=2):
+def generateSSG(Kset, CDR3s, k_thr=2, nMismatch=1):
     KD=Kset.KD
-    KI=Kset.KmerIndex()
+    KI=Kset.KmerIndex(nMismatch)
     KDnew=Kset.updateKD(KI)
     CD=Kset.CD
     LL=np.array(Kset.LL)
@@ -519,6 +746,100 @@ def InsertGap(Seq,n):
                 SeqList.append(SeqNew0)
     return SeqList
 
+## Integer alphabet of the vectorized scorer: the letters of blosum62n followed by the gap symbols of SeqComparison
+ScoreAlphabet='ACDEFGHIKLMNPQRSTVWYBZX.-*'
+ScoreIndex=np.full(256, 255, dtype=np.uint8)
+for ii in range(len(ScoreAlphabet)):
+    ScoreIndex[ord(ScoreAlphabet[ii])]=ii
+GapIndex=ScoreAlphabet.index('-')
+BlosumTables={}
+
+def BlosumTable(gap=-6):
+    ## Score table over ScoreAlphabet with the same values as SeqComparison: capped blosum62n between
+    ## letters, gap between a gap symbol and any other symbol, 0 between identical gap symbols
+    if gap not in BlosumTables:
+        nA=len(ScoreAlphabet)
+        T=np.zeros((nA, nA), dtype=np.int32)
+        for ii in range(nA):
+            for jj in range(nA):
+                aa=ScoreAlphabet[ii]
+                bb=ScoreAlphabet[jj]
+                if aa in ['.','-','*'] or bb in ['.','-','*']:
+                    T[ii,jj]=0 if aa==bb else gap
+                else:
+                    T[ii,jj]=blosum62n[(aa,bb)]
+        BlosumTables[gap]=T
+    return BlosumTables[gap]
+
+def SeqComparisonBatch(A, B, gap=-6):
+    ## Batch version of SeqComparison on ScoreIndex-encoded matrices of equal shape; returns one score per row
+    return BlosumTable(gap)[A,B].sum(axis=1)
+
+def NHLocalAlignmentPairs(Seqs, II, JJ, gap_thr=1, gap=-6):
+    ## Batch version of NHLocalAlignment on index pairs: scores of (Seqs[II[k]], Seqs[JJ[k]]), -1 if lengths differ by more than gap_thr
+    ## Each sequence is encoded once. Pairs are grouped by length and all gap placements are scored at once
+    ## with prefix and suffix sums along the alignment diagonals.
+    T=BlosumTable(gap)
+    II=np.asarray(II, dtype=np.int64)
+    JJ=np.asarray(JJ, dtype=np.int64)
+    N=len(II)
+    scores=np.full(N, -1, dtype=np.int64)
+    if N==0:
+        return scores
+    LL=np.array([len(x) for x in Seqs], dtype=np.int64)
+    E=np.zeros((len(Seqs), LL.max()), dtype=np.uint8)
+    for L in np.unique(LL):
+        idx=np.where(LL==L)[0]
+        E[idx,:L]=CDR3toArray([Seqs[x] for x in idx], ScoreIndex)
+    L1=LL[II]
+    L2=LL[JJ]
+    ## first sequence of a pair is the longer one
+    swap=L1<L2
+    Ilong=np.where(swap, JJ, II)
+    Ishort=np.where(swap, II, JJ)
+    Llong=np.maximum(L1, L2)
+    nnL=np.abs(L1-L2)
+    keys=Llong*100+nnL
+    for key in np.unique(keys[nnL<=gap_thr]):
+        idx=np.where(keys==key)[0]
+        nn=int(nnL[idx[0]])
+        if nn>2:
+            ## InsertGap only handles up to 2 gaps
+            for ii in idx:
+                scores[ii]=NHLocalAlignment(Seqs[II[ii]], Seqs[JJ[ii]], gap_thr, gap)
+            continue
+        n=int(Llong[idx[0]])-nn
+        A=E[Ilong[idx],:n+nn]
+        B=E[Ishort[idx],:n]
+        if nn==0:
+            scores[idx]=T[A,B].sum(axis=1)
+            continue
+        Nk=len(idx)
+        ## Gk[:,k]: score of a gap placed against A[:,k]
+        Gk=T[A, GapIndex]
+        ## P0[:,k]: b_i against a_i for i<k
+        P0=np.zeros((Nk, n+1), dtype=np.int64)
+        P0[:,1:]=np.cumsum(T[A[:,:n],B], axis=1)
+        if nn==1:
+            ## gap against a_k, b_i against a_(i+1) for i>=k
+            S1=np.zeros((Nk, n+1), dtype=np.int64)
+            S1[:,:n]=np.cumsum(T[A[:,1:],B][:,::-1], axis=1)[:,::-1]
+            scores[idx]=(P0+Gk[:,:n+1]+S1).max(axis=1)
+        else:
+            ## gaps against a_p1 and a_(p2+1) with p1<=p2; b_i against a_(i+1) for p1<=i<p2 and a_(i+2) for i>=p2
+            C1=np.zeros((Nk, n+1), dtype=np.int64)
+            C1[:,1:]=np.cumsum(T[A[:,1:n+1],B], axis=1)
+            S2=np.zeros((Nk, n+1), dtype=np.int64)
+            S2[:,:n]=np.cumsum(T[A[:,2:],B][:,::-1], axis=1)[:,::-1]
+            best1=np.maximum.accumulate(P0+Gk[:,:n+1]-C1, axis=1)
+            scores[idx]=(best1+C1+Gk[:,1:n+2]+S2).max(axis=1)
+    return scores
+
+def NHLocalAlignmentBatch(Seqs1, Seqs2, gap_thr=1, gap=-6):
+    ## Batch version of NHLocalAlignment: scores of the pairs (Seqs1[i], Seqs2[i])
+    N=len(Seqs1)
+    return NHLocalAlignmentPairs(list(Seqs1)+list(Seqs2), np.arange(N), np.arange(N, 2*N), gap_thr, gap)
+
 def falign(s1, s2, V1, V2 ,st,VScore={}, UseV=True, gapn=1, gap=-6):
     mid1=s1[st:-2]
     mid2=s2[st:-2]
@@ -540,29 +861,69 @@ def falign(s1, s2, V1, V2 ,st,VScore={}, UseV=True, gapn=1, gap=-6):
     score=aln/float(max(len(mid1),len(mid2)))+V_score
     return score
 
+def falignPairs(seqs, Vgenes, II, JJ, st, VScore={}, UseV=True, gapn=1, gap=-6):
+    ## Batch version of falign on index pairs: scores of (seqs[II[k]], seqs[JJ[k]]) with V genes Vgenes
+    II=np.asarray(II, dtype=np.int64)
+    JJ=np.asarray(JJ, dtype=np.int64)
+    mids=[x[st:-2] for x in seqs]
+    if UseV:
+        ## V gene score of every pair of distinct V genes present, then gathered for all pairs
+        Vnames=list(set(Vgenes))
+        Vidx={Vnames[ii]:ii for ii in range(len(Vnames))}
+        nV=len(Vnames)
+        VS=np.full((nV,nV), 4.0)
+        VF=np.ones((nV,nV), dtype=bool)
+        for aa in range(nV):
+            for bb in range(nV):
+                if aa==bb:
+                    continue
+                Vkey=(Vnames[aa],Vnames[bb])
+                if Vkey not in VScore:
+                    Vkey=(Vnames[bb],Vnames[aa])
+                if Vkey not in VScore:
+                    VF[aa,bb]=False
+                else:
+                    VS[aa,bb]=VScore[Vkey]/20.0
+        vid=np.array([Vidx[x] for x in Vgenes], dtype=np.int64)
+        V_score=VS[vid[II],vid[JJ]]
+        Vfound=VF[vid[II],vid[JJ]]
+    else:
+        V_score=np.full(len(II), 4.0)
+        Vfound=np.ones(len(II), dtype=bool)
+    aln=NHLocalAlignmentPairs(mids, II, JJ, gapn, gap)
+    LL=np.array([len(x) for x in mids], dtype=np.int64)
+    score=aln/np.maximum(LL[II], LL[JJ]).astype(float)+V_score
+    ## falign returns 0 when the V gene pair is not in the score table
+    score[~Vfound]=0
+    return score
+
+def falignBatch(s1L, s2L, V1L, V2L, st, VScore={}, UseV=True, gapn=1, gap=-6):
+    ## Batch version of falign: scores of the pairs (s1L[i], s2L[i]) with V genes (V1L[i], V2L[i])
+    N=len(s1L)
+    return falignPairs(list(s1L)+list(s2L), list(V1L)+list(V2L), np.arange(N), np.arange(N, 2*N), st, VScore=VScore, UseV=UseV, gapn=gapn, gap=gap)
+
+def ScorePairs(II, JJ, seqs, Vgenes, Vscore={}, UseV=True, gap=-6, gapn=1, cutoff=7.5, st=3):
+    ## Score all candidate pairs (II[k], JJ[k]) of a cluster in one call; returns the boolean mask of pairs with score>=cutoff
+    if len(II)==0:
+        return np.zeros(0, dtype=bool)
+    return falignPairs(seqs, Vgenes, II, JJ, st, VScore=Vscore, UseV=UseV, gapn=gapn, gap=gap)>=cutoff
+
 def UpdateSSG(SSG, seqs, Vgenes, Vscore={}, UseV=True, gap=-6, gapn=1, cutoff=7.5):
-    SSGnew={}
-    count=0
-    t1=time.time()
-    N=len(list(chain(*list(SSG.values()))))
-#    print("Number of pairs to be processed: %d" %N)
+    ## Keep the edges of the sequence share graph with alignment score>=cutoff
+    II=[]
+    JJ=[]
     for kk in SSG:
-        s1=seqs[kk]
-        V1=Vgenes[kk]
-        VV=SSG[kk]
-        for vv in VV:
-            s2=seqs[vv]
-            V2=Vgenes[vv]
-            score=falign(s1, s2, V1, V2, st=3, VScore=Vscore, UseV=UseV, gap=-6, gapn=1)
-            count+=1
-            if count % 1000000 ==0:
-                t2=time.time()
-#                print("Processed %d pairs. Elapsed time %f" %(count, t2-t1))
-            if score>=cutoff:
-                if kk not in SSGnew:
-                    SSGnew[kk]=[vv]
-                else:
-                    SSGnew[kk].append(vv)
+        for vv in SSG[kk]:
+            II.append(kk)
+            JJ.append(vv)
+    keep=ScorePairs(II, JJ, seqs, Vgenes, Vscore=Vscore, UseV=UseV, gap=gap, gapn=gapn, cutoff=cutoff)
+    SSGnew={}
+    for ii in np.where(keep)[0]:
+        kk=II[ii]
+        if kk not in SSGnew:
+            SSGnew[kk]=[JJ[ii]]
+        else:
+            SSGnew[kk].append(JJ[ii])
     return SSGnew
 
 def dfs(graph, start):
@@ -579,41 +940,89 @@ def dfs(graph, start):
     
     return visited
 
+def EdgeComponents(II, JJ):
+    ## Connected components of the undirected graph with edges (II[k], JJ[k]), by array-backed union-find
+    ## Node IDs can be any hashable values; components and their members are in order of first appearance
+    nodes=list(dict.fromkeys(chain(II, JJ)))
+    n=len(nodes)
+    nodeIdx={nodes[ii]:ii for ii in range(n)}
+    parent=list(range(n))
+    def find(x):
+        while parent[x]!=x:
+            parent[x]=parent[parent[x]]
+            x=parent[x]
+        return x
+    for a, b in zip(II, JJ):
+        ra=find(nodeIdx[a])
+        rb=find(nodeIdx[b])
+        if ra<rb:
+            parent[rb]=ra
+        elif rb<ra:
+            parent[ra]=rb
+    CompDict={}
+    for ii in range(n):
+        rr=find(ii)
+        if rr not in CompDict:
+            CompDict[rr]=[nodes[ii]]
+        else:
+            CompDict[rr].append(nodes[ii])
+    return list(CompDict.values())
+
 def IdentifyMotifCluster(SSG):
     ## Input SeqShareGraph dictionary representation of sparse matrix
-    POS=set(SSG.keys())
-    NP=len(POS)
-    ClusterList=[]
-    tmpL=set(chain(*ClusterList))
-    count=0
-    while 1:
-            xx=POS ^ tmpL
-            if len(xx)==0:
-                break
-            for ii in xx:
-#            STACK=LoadComm([],ii)
-                STACK=dfs(SSG,ii)
-                tmpL = tmpL | STACK
-                ClusterList.append(list(STACK))
-#                tmpL=set(chain(*ClusterList))
-                count+=1
-                if count % 200 ==0:
-                    print ("    Solved %d clusters" %(count))
-                break
-    return ClusterList
+    ## Each key is a node, linked to itself so that it is kept without neighbors
+    II=list(SSG.keys())
+    JJ=list(SSG.keys())
+    for kk in SSG:
+        II+=[kk]*len(SSG[kk])
+        JJ+=list(SSG[kk])
+    return EdgeComponents(II, JJ)
 
 def IdentifyVgeneCluster(sMat):
     ## Input Vgene score matrix
-    vG={}
-    n=len(sMat)
-    IDs=[x for x in range(n)]
-    for kk in IDs:
-        LL=sMat[:,kk]
-        vL=np.where(LL>=thr_v)[0]
-        if len(vL)>0:
-            vG[kk]=vL
-    CL=IdentifyMotifCluster(vG)
-    return CL
+    II, JJ=np.where(sMat>=thr_v)
+    return EdgeComponents(JJ.tolist(), II.tolist())
+
+def VgeneSplit(vid, VCompat):
+    ## Split a cluster by V gene: connected components of its members under V gene compatibility
+    ## vid: integer V gene IDs of the members. Members with the same V gene have the same partners, so components
+    ## are found on the distinct V genes. Members without a compatible partner are left out.
+    ## Components and members are ordered as IdentifyMotifCluster does on the pairwise member graph
+    Nc=len(vid)
+    ug, firstPos, inv, cnt=np.unique(vid, return_index=True, return_inverse=True, return_counts=True)
+    C=VCompat[np.ix_(ug,ug)]
+    selfC=np.diag(C).copy()
+    ## number of compatible partners of each member
+    deg=(C.astype(np.int64) @ cnt)[inv]-selfC[inv]
+    ## position of the second member of each V gene
+    order=np.argsort(inv, kind='stable')
+    secondPos=np.full(len(ug), Nc)
+    multi=cnt>1
+    secondPos[multi]=order[(np.cumsum(cnt)-cnt)[multi]+1]
+    minFirst=np.where(C, firstPos[None,:], Nc).min(axis=1)
+    np.fill_diagonal(C, False)
+    minFirstOther=np.minimum(np.where(C, firstPos[None,:], Nc).min(axis=1), np.where(selfC, secondPos, Nc))
+    ## a member first appears in the pair enumeration either as the partner of its earliest compatible member,
+    ## or, if there is none, as the first of its pair with the next compatible member
+    pos=np.arange(Nc)
+    earlier=minFirst[inv]<pos
+    row=np.where(earlier, minFirst[inv], pos)
+    col=np.where(earlier, pos, minFirstOther[inv])
+    nodes=np.where(deg>0)[0]
+    nodes=nodes[np.lexsort((col[nodes], row[nodes]))]
+    II, JJ=np.where(C)
+    gComp=EdgeComponents(list(range(len(ug)))+II.tolist(), list(range(len(ug)))+JJ.tolist())
+    gLabel=np.zeros(len(ug), dtype=np.int64)
+    for ii in range(len(gComp)):
+        gLabel[gComp[ii]]=ii
+    CompDict={}
+    for x in nodes.tolist():
+        ll=gLabel[inv[x]]
+        if ll not in CompDict:
+            CompDict[ll]=[x]
+        else:
+            CompDict[ll].append(x)
+    return list(CompDict.values())
     
 def ParseFa(fname):
     InputStr=open(fname).readlines()
@@ -631,8 +1040,8 @@ def ParseFa(fname):
         FaDict[seqHead]=seq
     return FaDict
 
-def PreCalculateVgeneDist(VgeneFa="Imgt_Human_TRBV.fasta"):
-    ## Only run one time if needed
+def VgeneScoreTable(VgeneFa="Imgt_Human_TRBV.fasta"):
+    ## CDR1 and CDR2 comparison scores of all pairs of V genes in VgeneFa, keyed by (V1, V2) with V1 before V2 in the file
     FaDict=ParseFa(cur_dir+VgeneFa)
     VScore={}
     CDR1Dict={}
@@ -658,6 +1067,12 @@ def PreCalculateVgeneDist(VgeneFa="Imgt_Human_TRBV.fasta"):
             score2=SeqComparison(s2_CDR2,s2_CDR2)
             #print score1+score2
             VScore[(V1,V2)]=score1+score2
+    return VScore
+
+def PreCalculateVgeneDist(VgeneFa="Imgt_Human_TRBV.fasta"):
+    ## Only run one time if needed
+    ## Writes the V gene score table into VgeneScores.txt
+    VScore=VgeneScoreTable(VgeneFa)
     gg=open('VgeneScores.txt','w')
     for kk in VScore:
         vv=VScore[kk]
@@ -665,13 +1080,120 @@ def PreCalculateVgeneDist(VgeneFa="Imgt_Human_TRBV.fasta"):
         gg.write(line)
     gg.close()
 
-def EncodeRepertoire(inputfile, outdir, outfile='',exact=True, ST=3, thr_v=3.7, thr_s=3.5, VDict={},Vgene=True,thr_iso=10, gap=-6, GPU=False, verbose=False):
+def SaveNpzAtomic(npzFile, **arrays):
+    ## np.savez of arrays into npzFile, written to a per-process temporary file and renamed, so a reader or a concurrent
+    ## job never loads a partial file. The temporary file is removed if saving fails
+    tmpFile=npzFile+'.'+str(os.getpid())+'.npz'
+    try:
+        np.savez(tmpFile, **arrays)
+        os.replace(tmpFile, npzFile)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+def LoadVgeneScores(VgeneFa="Imgt_Human_TRBV.fasta", rebuild=False):
+    ## V gene names and the symmetric matrix of their scores (score/20) for VgeneFa
+    ## The table is computed once per FASTA content and kept in a binary cache file next to the FASTA, loaded with a single read.
+    ## rebuild: recompute and overwrite the cache
+    with open(cur_dir+VgeneFa,'rb') as h:
+        faHash=hashlib.md5(h.read()+VgeneScoreVersion.encode()).hexdigest()
+    cacheFile=cur_dir+re.sub('\\.[a-z]+$','',VgeneFa)+'-VgeneScores-'+faHash[:16]+'.npz'
+    if not rebuild and os.path.exists(cacheFile):
+        with np.load(cacheFile) as D:
+            return D['Vnames'].tolist(), D['scores']/20
+    VScore=VgeneScoreTable(VgeneFa)
+    Vnames=list(dict.fromkeys([x[0] for x in VScore]))
+    VIndex={Vnames[ii]:ii for ii in range(len(Vnames))}
+    scores=np.zeros((len(Vnames),len(Vnames)), dtype=np.int64)
+    for (v1, v2) in VScore:
+        scores[VIndex[v1],VIndex[v2]]=VScore[(v1,v2)]
+        scores[VIndex[v2],VIndex[v1]]=VScore[(v1,v2)]
+    try:
+        SaveNpzAtomic(cacheFile, Vnames=np.array(Vnames), scores=scores)
+    except OSError:
+        print("Warning: cannot write V gene score cache "+cacheFile)
+    return Vnames, scores/20
+
+def LoadVgeneCompatibility(VgeneFa="Imgt_Human_TRBV.fasta", thr_v=3.7, rebuild=False):
+    ## V gene IDs and compatibility matrix from the cached score table of VgeneFa (see LoadVgeneScores)
+    Vnames, VMat = LoadVgeneScores(VgeneFa, rebuild=rebuild)
+    return {Vnames[ii]:ii for ii in range(len(Vnames))}, VMat>=thr_v
+
+def VgeneCompatibility(VScore, thr_v=3.7):
+    ## Intern the V genes of the score table to integer IDs and build the boolean matrix of compatible V gene pairs
+    ## Two V genes are compatible if their score is >= thr_v. This includes a V gene with itself: a few genes
+    ## score below thr_v against themselves in the table. Genes missing from the table are compatible with themselves only.
+    Vnames=sorted(set([x[0] for x in VScore]) | set([x[1] for x in VScore]))
+    VIndex={Vnames[ii]:ii for ii in range(len(Vnames))}
+    VCompat=np.zeros((len(Vnames),len(Vnames)), dtype=bool)
+    for (v1, v2) in VScore:
+        if VScore[(v1,v2)]>=thr_v:
+            VCompat[VIndex[v1],VIndex[v2]]=True
+            VCompat[VIndex[v2],VIndex[v1]]=True
+    return VIndex, VCompat
+
+def InternVgenes(vgs, VIndex, VCompat):
+    ## Extend the V gene IDs with the genes of vgs missing from the score table, compatible only with themselves
+    VIndex=dict(VIndex)
+    for vv in vgs:
+        if vv not in VIndex:
+            VIndex[vv]=len(VIndex)
+    nV=VCompat.shape[0]
+    if len(VIndex)>nV:
+        VC=np.eye(len(VIndex), dtype=bool)
+        VC[:nV,:nV]=VCompat
+        VCompat=VC
+    return VIndex, VCompat
+
+def EncodeRepertoire(inputfile, outdir, outfile='',exact=True, ST=3, thr_v=3.7, thr_s=3.5, VDict={},Vgene=True,thr_iso=10, gap=-6, GPU=False, verbose=False, eStore=None, indexType='flat', indexReport=False, clusterMode='merge', nProc=1, swProc=1, VIndex=None, VCompat=None, streaming=False, chunkSize=100000, mmapDir=None, compression='none', compressDim=PCADim, columnar=False, sampleLabels=None):
     ## No V gene version
     ## Encode CDR3 sequences into 96 dimensional space and perform k-means clustering
     ## If exact is True, SW alignment will be performed within each cluster after isometric encoding and clustering
-    h=open(inputfile)
-    t1=time.time()
-    alines=h.readlines()
+    ## clusterMode: 'merge' uses the iterative 2-NN merging of ClusterCDR3, 'range' uses the single range search of ClusterCDR3r
+    ## nProc: number of worker processes clustering length buckets in parallel
+    ## swProc: number of worker processes for Smith-Waterman refinement of large clusters, used when nProc is 1
+    ## VIndex, VCompat: integer V gene IDs and V gene compatibility matrix from VgeneCompatibility, built from VDict if not given
+    ## streaming: read the input in chunks of chunkSize lines and spill each length bucket to a temporary file, then
+    ## load and cluster one bucket at a time, so memory is bounded by the largest bucket instead of the whole input
+    ## mmapDir: directory for memory-mapped encoding matrices and merge buffers of buckets with at least MmapMinSize CDR3s
+    ## compression: one of Compressions, applied to the vectors of each length bucket before clustering (see MakeIndex)
+    ## columnar: also save the output as a columnar .npz file next to it (see SaveClusterColumns)
+    ## sampleLabels: sample -> label map; if given, the label composition of each cluster is saved next to the output (see SaveClusterComposition)
+    CheckClusterOptions(clusterMode, compression, indexType, indexReport)
+    if streaming:
+        EncodeRepertoireStreaming(inputfile, outdir, outfile, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, VDict=VDict, Vgene=Vgene, thr_iso=thr_iso, gap=gap, GPU=GPU,
+                                  verbose=verbose, eStore=eStore, indexType=indexType, indexReport=indexReport, clusterMode=clusterMode, nProc=nProc, swProc=swProc,
+                                  VIndex=VIndex, VCompat=VCompat, chunkSize=chunkSize, mmapDir=mmapDir,
+                                  compression=compression, compressDim=compressDim, columnar=columnar, sampleLabels=sampleLabels)
+        return
+    if verbose:
+        print('Creating CDR3 list')
+    seqs, vgs, infoList = ReadRepertoire(inputfile, Vgene=Vgene)
+    g=ClusterWriter(OpenClusterOutput(inputfile, outdir, outfile, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, Vgene=Vgene, thr_iso=thr_iso), columnar=columnar, Vgene=Vgene, sampleLabels=sampleLabels)
+    ClusterSequences(seqs, vgs, infoList, g, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, VDict=VDict, Vgene=Vgene, thr_iso=thr_iso, gap=gap, GPU=GPU,
+                     verbose=verbose, eStore=eStore, indexType=indexType, indexReport=indexReport, clusterMode=clusterMode, nProc=nProc, swProc=swProc,
+                     VIndex=VIndex, VCompat=VCompat, mmapDir=mmapDir, compression=compression, compressDim=compressDim)
+    g.close()
+
+def CheckClusterOptions(clusterMode='merge', compression='none', indexType='flat', indexReport=False):
+    if clusterMode not in ['merge','range']:
+        raise ValueError("Unknown clustering mode: "+str(clusterMode))
+    if compression not in Compressions:
+        raise ValueError("Unknown compression: "+str(compression))
+    if indexType not in IndexTypes:
+        raise ValueError("Unknown index type: "+str(indexType))
+    if clusterMode=='range' and compression in ['sq8','pq']:
+        raise ValueError("Range search clustering only supports pca compression")
+    if clusterMode=='range' and indexType!='flat':
+        raise ValueError("Range search clustering only supports the flat index")
+    if clusterMode=='range' and indexReport:
+        raise ValueError("Range search clustering does not support the index report")
+
+def ReadRepertoire(inputfile, Vgene=True):
+    ## CDR3s of an input file with their V genes (empty without Vgene) and the tab-joined other columns of each
+    ## A header line is skipped, as are CDR3s containing * or _
+    with open(inputfile) as h:
+        alines=h.readlines()
     ww=alines[0].strip().split('\t')
     if not ww[0].startswith('C'):
         ## header line
@@ -685,9 +1207,6 @@ def EncodeRepertoire(inputfile, outdir, outfile='',exact=True, ST=3, thr_v=3.7,
     seqs=[]
     vgs=[]
     infoList=[]
-    count=0
-    if verbose:
-        print('Creating CDR3 list')
     for ll in alines:
         ww=ll.strip().split('\t')
         cdr3=ww[0]
@@ -701,356 +1220,931 @@ def EncodeRepertoire(inputfile, outdir, outfile='',exact=True, ST=3, thr_v=3.7,
             infoList.append('\t'.join(ww[1:]))
         else:
             infoList.append('\t'.join(ww[1:]))
-        count+=1
+    return seqs, vgs, infoList
+
+def ClusterSequences(seqs, vgs, infoList, g, exact=True, ST=3, thr_v=3.7, thr_s=3.5, VDict={}, Vgene=True, thr_iso=10, gap=-6, GPU=False, verbose=False, eStore=None, indexType='flat', indexReport=False, clusterMode='merge', nProc=1, swProc=1, VIndex=None, VCompat=None, mmapDir=None, compression='none', compressDim=PCADim):
+    ## Cluster the CDR3s seqs with V genes vgs and information fields infoList (see ReadRepertoire) and queue the output rows
+    ## into the ClusterWriter g, which the caller closes. Parameters as in EncodeRepertoire
+    gr=0
+    ## Split into different lengths
+    LD,VD, ID,SD= BuildLengthDict(seqs, vGene=vgs,INFO=infoList,sIDs=[x for x in range(len(seqs))])
+    LDu, VDu, IDu, SDu = CollapseUnique(LD, VD, ID, SD)
+    VIDu={}
+    if Vgene:
+        if VIndex is None:
+            VIndex, VCompat = VgeneCompatibility(VDict, thr_v)
+        VIndex, VCompat = InternVgenes(vgs, VIndex, VCompat)
+        for kk in VDu:
+            VIDu[kk]=np.array([VIndex[x] for x in VDu[kk]], dtype=np.int64)
+    params={'exact':exact, 'ST':ST, 'thr_v':thr_v, 'thr_s':thr_s, 'VCompat':VCompat, 'Vgene':Vgene, 'thr_iso':thr_iso, 'gap':gap,
+            'GPU':GPU, 'verbose':verbose, 'indexType':indexType, 'indexReport':indexReport, 'clusterMode':clusterMode, 'mmapDir':mmapDir,
+            'compression':compression, 'compressDim':compressDim}
+    if nProc>1:
+        ## Length buckets are clustered in worker processes, largest first. Results are written in the
+        ## original bucket order, so cluster ids are the same as in a serial run.
+        pool=Pool(processes=nProc, initializer=InitBucketWorker, initargs=(faiss.omp_get_max_threads(),))
+        jobs={}
+        for kk in sorted(LDu, key=lambda x: -len(SDu[x])):
+            vInfo=IDu[kk]
+            flagL=[len(x)-1 for x in vInfo]
+            ## The embedding store is not shared between processes: encode here if one is used
+            dM=EncodeCDR3List(SDu[kk], ST, eStore) if eStore is not None else None
+            jobs[kk]=pool.apply_async(ClusterLengthBucket, (kk, SDu[kk], flagL, VIDu.get(kk, []), dM), params)
+        pool.close()
+        for kk in LDu:
+            groups=jobs[kk].get()
+            del jobs[kk]
+            gr=WriteClusterGroups(g, groups, SDu[kk], IDu[kk], gr)
+        pool.join()
+    else:
+        ## Smith-Waterman refinement can use its own pool when buckets are processed serially
+        swPool=None
+        if swProc>1 and exact:
+            swPool=Pool(processes=swProc)
+        for kk in LDu:
+            vInfo=IDu[kk]
+            flagL=[len(x)-1 for x in vInfo]
+            groups=ClusterLengthBucket(kk, SDu[kk], flagL, VIDu.get(kk, []), eStore=eStore, swPool=swPool, swChunks=4*swProc, **params)
+            if verbose:
+                print(' Writing results into file')
+            gr=WriteClusterGroups(g, groups, SDu[kk], vInfo, gr)
+        if swPool is not None:
+            swPool.close()
+            swPool.join()
+
+def ClusterRepertoire(seqs, infos, outfile='', source='', exact=True, ST=3, thr_v=3.7, thr_s=3.5, VDict={}, Vgene=True, thr_iso=10, gap=-6, GPU=False, verbose=False, eStore=None, indexType='flat', indexReport=False, clusterMode='merge', nProc=1, swProc=1, VIndex=None, VCompat=None, mmapDir=None, compression='none', compressDim=PCADim, columnar=False, sampleLabels=None, nThreads=None):
+    ## In-process clustering of the CDR3s seqs, with infos the tab-joined other input columns of each (the V gene first if Vgene)
+    ## Returns the output rows as columns in the format of LoadClusterColumns, in the order they are written to a cluster file
+    ## outfile: if given, also write the cluster file there, with its columnar file if columnar and composition file if sampleLabels are given
+    ## source: input name recorded in the header line of outfile
+    ## nThreads: number of OpenMP threads used by faiss, unchanged if None
+    ## Other parameters as in EncodeRepertoire
+    CheckClusterOptions(clusterMode, compression, indexType, indexReport)
+    if nThreads is not None:
+        faiss.omp_set_num_threads(nThreads)
+    keep=[ii for ii in range(len(seqs)) if '*' not in seqs[ii] and '_' not in seqs[ii]]
+    seqs=[seqs[ii] for ii in keep]
+    infos=[infos[ii] for ii in keep]
+    vgs=[x.split('\t',1)[0] for x in infos] if Vgene else []
+    if len(outfile)>0:
+        g=ClusterWriter(OpenClusterOutput(source, '', outfile, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, Vgene=Vgene, thr_iso=thr_iso), columnar=columnar, Vgene=Vgene, sampleLabels=sampleLabels, keepColumns=True)
+    else:
+        g=ClusterWriter(None, Vgene=Vgene, keepColumns=True)
+    ClusterSequences(seqs, vgs, infos, g, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, VDict=VDict, Vgene=Vgene, thr_iso=thr_iso, gap=gap, GPU=GPU,
+                     verbose=verbose, eStore=eStore, indexType=indexType, indexReport=indexReport, clusterMode=clusterMode, nProc=nProc, swProc=swProc,
+                     VIndex=VIndex, VCompat=VCompat, mmapDir=mmapDir, compression=compression, compressDim=compressDim)
+    g.close()
+    return g.columns
+
+def ClusterOutputFile(inputfile, outdir):
+    ## Default cluster output file of inputfile in outdir
+    outfile=inputfile.split('/')
+    outfile=outfile[len(outfile)-1]
+    return outdir+'/'+re.sub('\\.[txcsv]+','',outfile)+'-'+'-RotationEncodingBL62.txt'
+
+def OpenClusterOutput(inputfile, outdir, outfile='', exact=True, ST=3, thr_v=3.7, thr_s=3.5, Vgene=True, thr_iso=10):
+    ## Open the clustering output file of inputfile and write its header lines
     if len(outfile)==0:
-        outfile=inputfile.split('/')
-        outfile=outfile[len(outfile)-1]
-        outfile=outdir+'/'+re.sub('\\.[txcsv]+','',outfile)+'-'+'-RotationEncodingBL62.txt'
+        outfile=ClusterOutputFile(inputfile, outdir)
     g=open(outfile,'w')
     tm=strftime("%Y-%m-%d %H:%M:%S", gmtime())
     InfoLine='##TIME:'+tm+'|cmd: '+sys.argv[0]+'|'+inputfile+'|IsometricDistance_Thr='+str(thr_iso)+'|thr_v='+str(thr_v)+'|thr_s='+str(thr_s)+'|exact='+str(exact)+'|Vgene='+str(Vgene)+'|ST='+str(ST)
     g.write(InfoLine+'\n')
     g.write("##Column Info: CDR3 aa sequence, cluster id, other information in the input file\n")
-    gr=0
-    ## Split into different lengths
+    return g
+
+def SpillLengthBuckets(inputfile, spillDir, chunkSize=100000):
+    ## Read inputfile in chunks of chunkSize lines and append each CDR3 line to the spill file of its length bucket
+    ## CDR3s are filtered as in EncodeRepertoire and BuildLengthDict. Returns the spill files keyed by CDR3 length,
+    ## in order of first appearance of each length, as the length buckets of BuildLengthDict.
+    AAs=set(list(AAencodingDict.keys()))
+    LLs=set(range(10,25))
+    bucketFiles={}
+    cNAs=0
+    h=open(inputfile)
+    first=True
+    while 1:
+        alines=list(islice(h, chunkSize))
+        if len(alines)==0:
+            break
+        if first:
+            ww=alines[0].strip().split('\t')
+            if not ww[0].startswith('C') or 'CDR3' in ww[0]:
+                ## header line
+                alines=alines[1:]
+            first=False
+        chunk={}
+        for ll in alines:
+            ll=ll.strip()
+            cdr3=ll.split('\t',1)[0]
+            if '*' in cdr3 or '_' in cdr3:
+                continue
+            if not set(cdr3) <= AAs:
+                cNAs+=1
+                continue
+            L=len(cdr3)
+            if L not in LLs:
+                continue
+            if L not in chunk:
+                chunk[L]=[ll+'\n']
+            else:
+                chunk[L].append(ll+'\n')
+        for L in chunk:
+            if L not in bucketFiles:
+                bucketFiles[L]=spillDir+'/bucket_'+str(L)+'.txt'
+            with open(bucketFiles[L],'a') as gs:
+                gs.writelines(chunk[L])
+    h.close()
+    if cNAs>0:
+        print("Warning: Skipped %d sequences with non AA letter!" %(cNAs))
+    return bucketFiles
+
+def ClusterSpilledBucket(kk, bucketFile, g, gr, params, VIndex=None, VCompat=None, eStore=None, swPool=None, swChunks=4):
+    ## Load one spilled length bucket, cluster it with ClusterLengthBucket and write its groups to g after cluster id gr
+    ## Returns the last cluster id used
+    Vgene=params['Vgene']
+    seqs=[]
+    vgs=[]
+    infoList=[]
+    for ll in open(bucketFile):
+        ww=ll.strip().split('\t')
+        seqs.append(ww[0])
+        if Vgene:
+            vgs.append(ww[1])
+        infoList.append('\t'.join(ww[1:]))
     LD,VD, ID,SD= BuildLengthDict(seqs, vGene=vgs,INFO=infoList,sIDs=[x for x in range(len(seqs))])
+    del seqs, vgs, infoList
     LDu, VDu, IDu, SDu = CollapseUnique(LD, VD, ID, SD)
-    for kk in LDu:
+    del LD, VD, ID, SD
+    vid=[]
+    if Vgene:
+        VIndex, VCompat = InternVgenes(VDu[kk], VIndex, VCompat)
+        vid=np.array([VIndex[x] for x in VDu[kk]], dtype=np.int64)
+    params=dict(params)
+    params['VCompat']=VCompat
+    flagL=[len(x)-1 for x in IDu[kk]]
+    groups=ClusterLengthBucket(kk, SDu[kk], flagL, vid, eStore=eStore, swPool=swPool, swChunks=swChunks, **params)
+    return WriteClusterGroups(g, groups, SDu[kk], IDu[kk], gr)
+
+def ClusterSpilledBucketPart(kk, bucketFile, partFile, params, VIndex=None, VCompat=None):
+    ## Worker task: cluster one spilled length bucket into its own part file, with cluster ids starting from 1
+    with open(partFile,'w') as g:
+        return ClusterSpilledBucket(kk, bucketFile, g, 0, params, VIndex=VIndex, VCompat=VCompat)
+
+def AppendClusterPart(g, partFile, gr):
+    ## Copy a part file into the ClusterWriter g, shifting its cluster ids by gr; returns the last cluster id used
+    nG=0
+    with open(partFile) as h:
+        while 1:
+            alines=list(islice(h, EncodeBlockSize))
+            if len(alines)==0:
+                break
+            seqs=[]
+            ids=[]
+            infos=[]
+            for ll in alines:
+                ww=ll.rstrip('\n').split('\t',2)
+                nG=int(ww[1])
+                seqs.append(ww[0])
+                ids.append(nG+gr)
+                infos.append(ww[2])
+            g.addLines(seqs, ids, infos)
+    return gr+nG
+
+def EncodeRepertoireStreaming(inputfile, outdir, outfile='', exact=True, ST=3, thr_v=3.7, thr_s=3.5, VDict={}, Vgene=True, thr_iso=10, gap=-6, GPU=False, verbose=False,
+                              eStore=None, indexType='flat', indexReport=False, clusterMode='merge', nProc=1, swProc=1, VIndex=None, VCompat=None, chunkSize=100000, mmapDir=None, compression='none', compressDim=PCADim, columnar=False, sampleLabels=None):
+    ## Streaming version of EncodeRepertoire: length buckets are spilled to temporary files and clustered one at a time
+    ## Cluster ids and output are the same as EncodeRepertoire
+    if Vgene and VIndex is None:
+        VIndex, VCompat = VgeneCompatibility(VDict, thr_v)
+    spillDir=tempfile.mkdtemp(prefix='giana_spill_', dir=outdir)
+    try:
         if verbose:
-            print("---Process CDR3s with length %d ---" %(kk))
-        vSD=LDu[kk]
-        vSD0=[x for x in range(len(vSD))]
-        vss=SDu[kk]
-        vInfo=IDu[kk]
-        flagL=[len(x)-1 for x in vInfo]
+            print('Spilling CDR3 length buckets into '+spillDir)
+        bucketFiles=SpillLengthBuckets(inputfile, spillDir, chunkSize)
+        g=ClusterWriter(OpenClusterOutput(inputfile, outdir, outfile, exact=exact, ST=ST, thr_v=thr_v, thr_s=thr_s, Vgene=Vgene, thr_iso=thr_iso), columnar=columnar, Vgene=Vgene, sampleLabels=sampleLabels)
+        gr=0
+        params={'exact':exact, 'ST':ST, 'thr_v':thr_v, 'thr_s':thr_s, 'Vgene':Vgene, 'thr_iso':thr_iso, 'gap':gap,
+                'GPU':GPU, 'verbose':verbose, 'indexType':indexType, 'indexReport':indexReport, 'clusterMode':clusterMode, 'mmapDir':mmapDir,
+                'compression':compression, 'compressDim':compressDim}
+        if nProc>1:
+            ## Workers load their own bucket and write a part file; parts are appended in bucket order with shifted cluster ids
+            if eStore is not None:
+                print("Warning: the embedding store is not used with streaming input and multiple processes.")
+            pool=Pool(processes=nProc, initializer=InitBucketWorker, initargs=(faiss.omp_get_max_threads(),))
+            jobs={}
+            for kk in sorted(bucketFiles, key=lambda x: -os.path.getsize(bucketFiles[x])):
+                jobs[kk]=pool.apply_async(ClusterSpilledBucketPart, (kk, bucketFiles[kk], spillDir+'/part_'+str(kk)+'.txt', params, VIndex, VCompat))
+            pool.close()
+            for kk in bucketFiles:
+                jobs[kk].get()
+                gr=AppendClusterPart(g, spillDir+'/part_'+str(kk)+'.txt', gr)
+                os.remove(bucketFiles[kk])
+                os.remove(spillDir+'/part_'+str(kk)+'.txt')
+            pool.join()
+        else:
+            swPool=None
+            if swProc>1 and exact:
+                swPool=Pool(processes=swProc)
+            for kk in bucketFiles:
+                gr=ClusterSpilledBucket(kk, bucketFiles[kk], g, gr, params, VIndex=VIndex, VCompat=VCompat, eStore=eStore, swPool=swPool, swChunks=4*swProc)
+                os.remove(bucketFiles[kk])
+            if swPool is not None:
+                swPool.close()
+                swPool.join()
+        g.close()
+    finally:
+        shutil.rmtree(spillDir, ignore_errors=True)
+
+def InitBucketWorker(nThreads):
+    ## Worker process initializer: keep the faiss thread setting of the parent
+    faiss.omp_set_num_threads(nThreads)
+
+def FormatClusterLines(members, ids, vss, vInfo):
+    ## Output lines for CDR3 indices members with cluster ids ids, one line per entry of vInfo
+    return ''.join(['%s\t%s\t%s\n' %(vss[jj], cc, v_info) for jj, cc in zip(members, ids) for v_info in vInfo[jj]])
+
+def ColumnarFile(clusterFile):
+    ## Columnar binary file written next to a cluster output file with -C
+    return re.sub('\\.txt$','',clusterFile)+'.npz'
+
+def DictionaryEncode(values):
+    ## Integer codes of values into the array of their distinct values, in order of first appearance
+    codes={}
+    cc=[codes.setdefault(x, len(codes)) for x in values]
+    return np.array(cc, dtype=np.int32), np.array(list(codes), dtype=str)
+
+def ClusterColumns(seqs, ids, infos, Vgene=True):
+    ## The rows of a cluster output file as columns:
+    ##   CDR3, info:      lists of the CDR3s and of the information fields of the rows
+    ##   cluster, length: cluster id and CDR3 length of each row
+    ##   Vgene, sample:   codes into Vgene_values and sample_values of the first (empty without V genes) and last information field
+    Vgenes=[x.split('\t',1)[0] for x in infos] if Vgene else ['']*len(infos)
+    Vcodes, Vvalues=DictionaryEncode(Vgenes)
+    Scodes, Svalues=DictionaryEncode([x.rsplit('\t',1)[-1] for x in infos])
+    return {'CDR3':seqs, 'info':infos, 'cluster':np.asarray(ids, dtype=np.int64), 'length':np.fromiter(map(len, seqs), dtype=np.int16, count=len(seqs)),
+            'Vgene':Vcodes, 'Vgene_values':Vvalues, 'sample':Scodes, 'sample_values':Svalues}
+
+def SaveClusterColumns(npzFile, C):
+    ## Save the columns C of a cluster output file (see ClusterColumns), with CDR3 and info as newline-joined UTF-8 bytes
+    D=dict(C)
+    for kk in ['CDR3','info']:
+        D[kk]=np.frombuffer('\n'.join(C[kk]).encode('utf-8'), dtype=np.uint8)
+    SaveNpzAtomic(npzFile, **D)
+
+def SidecarUpToDate(clusterFile, npzFile):
+    ## True if the file npzFile written next to a cluster output file exists and is not older than it
+    return os.path.exists(npzFile) and os.path.getmtime(npzFile)>=os.path.getmtime(clusterFile)
+
+def LoadClusterColumns(clusterFile, columns=None):
+    ## Columns of a cluster output file from its columnar file (see SaveClusterColumns) as a dict, with CDR3 and info
+    ## as lists of strings. columns: names of the arrays to load, all if None.
+    ## Returns None if there is no columnar file or it is older than the cluster file
+    npzFile=ColumnarFile(clusterFile)
+    if not SidecarUpToDate(clusterFile, npzFile):
+        return None
+    with np.load(npzFile) as D:
+        C={kk:D[kk] for kk in (D.files if columns is None else columns)}
+        nn=len(D['cluster'])
+    for kk in ['CDR3','info']:
+        if kk in C:
+            C[kk]=C[kk].tobytes().decode('utf-8').split('\n') if nn>0 else []
+    return C
+
+def CompositionFile(clusterFile):
+    ## Per-cluster composition summary written next to a cluster output file with -L
+    return re.sub('\\.txt$','',clusterFile)+'.composition.npz'
+
+def LoadClusterComposition(clusterFile):
+    ## Arrays of the composition file of a cluster output file (see SaveClusterComposition) as a dict
+    ## Returns None if there is no composition file or it is older than the cluster file
+    npzFile=CompositionFile(clusterFile)
+    if not SidecarUpToDate(clusterFile, npzFile):
+        return None
+    with np.load(npzFile) as D:
+        return {kk:D[kk] for kk in D.files}
+
+def LoadSampleLabels(labelFile):
+    ## Sample -> integer label map from a CSV file of sample name and label, such as labels.csv of AutoCAT; a header line is skipped
+    sampleLabels={}
+    with open(labelFile, newline='') as h:
+        for ww in csv.reader(h):
+            if len(ww)<2:
+                continue
+            try:
+                sampleLabels[ww[0]]=int(ww[1])
+            except ValueError:
+                continue
+    return sampleLabels
+
+def SaveClusterComposition(npzFile, ids, labelIdx, lengths, labelValues, sampleLabels):
+    ## Save the composition of each cluster from the cluster id, label index and CDR3 length of every output row:
+    ##   cluster, size, length:  cluster ids, number of rows and CDR3 length of each cluster
+    ##   labels, counts:         label values and the number of rows with each label in each cluster
+    ##   unlabelled:             number of rows of each cluster whose sample is not in sampleLabels
+    ##   samples, sampleLabels:  the sample -> label map used
+    cluster, first, inv=np.unique(ids, return_index=True, return_inverse=True)
+    nL=len(labelValues)
+    counts=np.bincount(inv*(nL+1)+labelIdx, minlength=len(cluster)*(nL+1)).reshape(len(cluster), nL+1)
+    SaveNpzAtomic(npzFile, cluster=cluster, size=counts.sum(axis=1), length=lengths[first].astype(np.int16),
+                  labels=np.array(labelValues, dtype=np.int64), counts=counts[:,:nL], unlabelled=counts[:,nL],
+                  samples=np.array(list(sampleLabels.keys()), dtype=str), sampleLabels=np.array(list(sampleLabels.values()), dtype=np.int64))
+
+class ClusterWriter:
+    ## Buffered writer of the clustering output file. The groups of a length bucket are queued as member and cluster id
+    ## arrays, then formatted in bulk and written by a background thread while the next bucket is clustered.
+    ## At most maxPending buckets wait in the queue; an error of the writing thread is raised by the next add, addLines or close
+    ## keepColumns: collect the rows and, after close, keep them in columns as returned by ClusterColumns. Always done if g is None
+    ## columnar: also save the collected rows with SaveClusterColumns next to the output file on close
+    ## sampleLabels: sample -> label map; if given, the composition of each cluster is saved with SaveClusterComposition on close.
+    ## The sample of a row is its last information field.
+    def __init__(self, g, maxPending=4, columnar=False, Vgene=True, sampleLabels=None, keepColumns=False):
+        self.g=g
+        self.error=None
+        self.queue=queue.Queue(maxsize=maxPending)
+        ## started with the first queued item, after any worker pools have been forked
+        self.thread=None
+        self.Vgene=Vgene
+        self.columnar=columnar
+        self.columns=[] if columnar or keepColumns or g is None else None
+        self.sampleLabels=sampleLabels
+        self.composition=None
+        if sampleLabels is not None:
+            self.labelValues=sorted(set(sampleLabels.values()))
+            self.labelIndex={ss:self.labelValues.index(ll) for ss, ll in sampleLabels.items()}
+            self.composition=[]
+    def _run(self):
+        while 1:
+            item=self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                if len(item)==3:
+                    seqs, ids, infos=item
+                    if self.g is not None:
+                        self.g.write(''.join(['%s\t%d\t%s\n' %(x, cc, v_info) for x, cc, v_info in zip(seqs, ids, infos)]))
+                else:
+                    members, ids, vss, vInfo=item
+                    members=members.tolist()
+                    if self.g is not None:
+                        self.g.write(FormatClusterLines(members, map(str, ids.tolist()), vss, vInfo))
+                    if self.columns is not None or self.composition is not None:
+                        ids=np.repeat(ids, [len(vInfo[jj]) for jj in members])
+                        seqs=[vss[jj] for jj in members for v_info in vInfo[jj]]
+                        infos=[v_info for jj in members for v_info in vInfo[jj]]
+                if self.columns is not None:
+                    self.columns.append((seqs, ids, infos))
+                if self.composition is not None:
+                    nL=len(self.labelValues)
+                    labelIdx=[self.labelIndex.get(x.rsplit('\t',1)[-1], nL) for x in infos]
+                    self.composition.append((np.asarray(ids, dtype=np.int64), np.array(labelIdx, dtype=np.int64),
+                                             np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))))
+            except Exception as e:
+                self.error=e
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread=threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put(item)
+    def add(self, groups, vss, vInfo, gr):
+        ## Queue the groups of one length bucket with consecutive cluster ids after gr; returns the last id used
+        if len(groups)>0:
+            members=np.fromiter(chain.from_iterable(groups), dtype=np.int64)
+            ids=np.repeat(np.arange(gr+1, gr+len(groups)+1), [len(cc) for cc in groups])
+            self._put((members, ids, vss, vInfo))
+        return gr+len(groups)
+    def addLines(self, seqs, ids, infos):
+        ## Queue output rows given as CDR3, cluster id and information columns
+        if len(seqs)>0:
+            self._put((seqs, ids, infos))
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.g is not None:
+            self.g.close()
+        if self.error is not None:
+            raise self.error
+        if self.columns is not None:
+            self.columns=ClusterColumns(list(chain.from_iterable([x[0] for x in self.columns])),
+                                        np.concatenate([x[1] for x in self.columns]+[np.zeros(0, dtype=np.int64)]),
+                                        list(chain.from_iterable([x[2] for x in self.columns])), Vgene=self.Vgene)
+            if self.columnar and self.g is not None:
+                SaveClusterColumns(ColumnarFile(self.g.name), self.columns)
+        if self.composition is not None and self.g is not None:
+            empty=[np.zeros(0, dtype=np.int64)]
+            SaveClusterComposition(CompositionFile(self.g.name), *[np.concatenate([x[ii] for x in self.composition]+empty) for ii in range(3)],
+                                   labelValues=self.labelValues, sampleLabels=self.sampleLabels)
+
+def WriteClusterGroups(g, groups, vss, vInfo, gr):
+    ## Write the output groups of one length bucket with consecutive cluster ids after gr; returns the last id used
+    ## g is a ClusterWriter or an open file
+    if isinstance(g, ClusterWriter):
+        return g.add(groups, vss, vInfo, gr)
+    members=list(chain.from_iterable(groups))
+    ids=map(str, np.repeat(np.arange(gr+1, gr+len(groups)+1), [len(cc) for cc in groups]).tolist())
+    g.write(FormatClusterLines(members, ids, vss, vInfo))
+    return gr+len(groups)
+
+def ClusterLengthBucket(kk, vss, flagL, vVgene, dM=None, eStore=None, swPool=None, swChunks=4, exact=True, ST=3, thr_v=3.7, thr_s=3.5, VCompat=None, Vgene=True, thr_iso=10, gap=-6, GPU=False, verbose=False, indexType='flat', indexReport=False, clusterMode='merge', mmapDir=None, compression='none', compressDim=PCADim):
+    ## Cluster the unique CDR3s vss of length kk: isometric clustering, V gene split and Smith-Waterman refinement
+    ## Returns the output groups in writing order; each group is a list of indices into vss and gets its own cluster id
+    ## dM: encoding matrix of vss, computed here (through eStore if given) when not provided
+    ## swPool: optional process pool for the Smith-Waterman refinement of large clusters, split into about swChunks tasks
+    ## vVgene: integer V gene IDs of vss, VCompat: V gene compatibility matrix
+    ## mmapDir: if given and the bucket has at least MmapMinSize CDR3s, the encoding matrix and merge buffers are memory-mapped there
+    ## compression: one of Compressions; pca reduces the encoding to compressDim dimensions before clustering
+    t1=time.time()
+    groups=[]
+    if verbose:
+        print("---Process CDR3s with length %d ---" %(kk))
+    if mmapDir is not None and len(vss)<MmapMinSize:
+        mmapDir=None
+    if dM is None:
         if verbose:
             print(' Performing CDR3 encoding')
-        dM=np.array([EncodingCDR3(x[ST:-2], M6, n0) for x in vss])
-        dM=dM.astype("float32")
-        if verbose:
-            print(" The number of sequences is %d" %(dM.shape[0]))
-        sID=[x for x in range(dM.shape[0])]
-        t2=time.time()
-        if verbose:
-            print(' Done! Total time elapsed %f' %(t2-t1))
-        Cls = ClusterCDR3(dM, flagL, thr=thr_iso - 0.5*(15-kk), verbose=verbose)  ## change cutoff with different lengths
+        dM=EncodeCDR3List(vss, ST, eStore, mmapDir)
+    if verbose:
+        print(" The number of sequences is %d" %(dM.shape[0]))
+    sID=[x for x in range(dM.shape[0])]
+    t2=time.time()
+    if verbose:
+        print(' Done! Total time elapsed %f' %(t2-t1))
+    t_c=time.time()
+    dMc=dM
+    if compression=='pca':
+        dMc, _ = ReduceEncoding(dM, compressDim)
+    if clusterMode=='range':
+        Cls = ClusterCDR3r(dMc, flagL, thr=thr_iso - 0.5*(15-kk), verbose=verbose)
+    else:
+        Cls = ClusterCDR3(dMc, flagL, thr=thr_iso - 0.5*(15-kk), GPU=GPU, verbose=verbose, indexType=indexType, bufDir=mmapDir, compression=compression)  ## change cutoff with different lengths
+    if indexReport and (indexType!='flat' or compression!='none') and clusterMode!='range':
+        IndexAgreementReport(dM, flagL, thr=thr_iso - 0.5*(15-kk), indexType=indexType, Cls=Cls, t_index=time.time()-t_c, GPU=GPU, compression=compression, compressDim=compressDim)
+    del dMc
+    if verbose:
+        print("     Handling identical CDR3 groups")
+    Cls_u=[]
+    for ii in range(len(Cls)):
+        cc=Cls[ii]
+        if len(cc) == 1:
+            ## Handle identical CDR3 groups first
+            if flagL[cc[0]]>0:
+                groups.append(cc)
+        else:
+            Cls_u.append(cc)
+    Cls=Cls_u
+    t2=time.time()
+    if verbose:
+        print(' Done! Total time elapsed %f' %(t2-t1))
+    if Vgene:
         if verbose:
-            print("     Handling identical CDR3 groups")
-        Cls_u=[]
-        for ii in range(len(Cls)):
-            cc=Cls[ii]
+            print('     Matching variable genes')
+        Cls_v=[]
+        for cc in Cls:
+            Nc=len(cc)
+            vCL=VgeneSplit(vVgene[np.array(cc)], VCompat)
+            vCL_List=set(chain(*vCL))
+            for ii in range(Nc):
+                uu=flagL[cc[ii]]
+                if uu>0 and ii not in vCL_List:
+                    vCL.append([ii])
+            for vcc in vCL:
+                Cls_v.append(list(np.array(cc)[np.array(vcc)]))
+        Cls=[]
+        for ii in range(len(Cls_v)):
+            cc=Cls_v[ii]
             if len(cc) == 1:
                 ## Handle identical CDR3 groups first
-                if flagL[cc[0]]>0:
-                    gr += 1
-                    jj=cc[0]
-                    for v_info in vInfo[jj]:
-                        line=vss[jj]+'\t'+str(gr)+'\t'+v_info+'\n'
-                        _=g.write(line)
+                groups.append(cc)
             else:
-                Cls_u.append(cc)
-        Cls=Cls_u
-        t2=time.time()
+                Cls.append(cc)
+    if exact:
         if verbose:
-            print(' Done! Total time elapsed %f' %(t2-t1))
-        if Vgene:
-            vVgene=VDu[kk]
-            if verbose:
-                print('     Matching variable genes')
-            Cls_v=[]
-            for cc in Cls:
-                Nc=len(cc)
-                sMat={}
+            print(' Performing Smith-Waterman alignment')
+        ## Clusters with more than 3 CDR3s are refined independently of each other, on swPool if given
+        large=[ii for ii in range(len(Cls)) if len(Cls[ii])>3]
+        CLallL=RefineClusters([Cls[ii] for ii in large], vss, flagL, ST=ST, thr_s=thr_s, pool=swPool, nChunks=swChunks)
+        CLallD=dict(zip(large, CLallL))
+        Cls_s=[]
+        for cc_id in range(len(Cls)):
+            cc=Cls[cc_id]
+            Nc=len(cc)
+            if len(cc)<=3:
+                sMat=np.zeros((Nc,Nc))
                 for ii in range(Nc):
-                    v1=vVgene[cc[ii]]
+                    s1=vss[cc[ii]]
                     for jj in range(ii,Nc):
                         if jj==ii:
                             continue
-                        v2=vVgene[cc[jj]]
-                        if (v1, v2) not in VDict:
-                            if v1 == v2:
-                                if ii not in sMat:
-                                    sMat[ii]=[jj]
-                                else:
-                                    sMat[ii].append(jj)
-                                if jj not in sMat:
-                                    sMat[jj]=[ii]
-                                else:
-                                    sMat[jj].append(ii)
+                        s2=vss[cc[jj]]
+                        if len(s1) != len(s2):
                             continue
-                        if VDict[(v1,v2)] >= thr_v:
-                                if ii not in sMat:
-                                    sMat[ii]=[jj]
-                                else:
-                                    sMat[ii].append(jj)
-                                if jj not in sMat:
-                                    sMat[jj]=[ii]
-                                else:
-                                    sMat[jj].append(ii)
-                vCL=IdentifyMotifCluster(sMat)
-                vCL_List=list(chain(*vCL))
+                        if len(s1)<=5:
+                            continue
+                        sw=SeqComparison(s1[ST:-2],s2[ST:-2],gap=gap)
+                        sw=sw/(len(s1)-ST-2)
+                        sMat[ii,jj]=sw
+                        sMat[jj,ii]=sw
+                s_max=[]
                 for ii in range(Nc):
-                    uu=flagL[cc[ii]]
-                    if uu>0 and ii not in vCL_List:
-                        vCL.append([ii])
-                for vcc in vCL:
-                    Cls_v.append(list(np.array(cc)[np.array(vcc)]))
-            Cls=[]
-            for ii in range(len(Cls_v)):
-                cc=Cls_v[ii]
-                if len(cc) == 1:
-                    ## Handle identical CDR3 groups first
-                    gr += 1
-                    jj=cc[0]
-                    for v_info in vInfo[jj]:
-                        line=vss[jj]+'\t'+str(gr)+'\t'+v_info+'\n'
-                        _=g.write(line)
+                    s_max.append(np.max(sMat[:,ii]))
+                cc_new=[]
+                for ii in range(Nc):
+                    if s_max[ii]>=thr_s:
+                        cc_new.append(cc[ii])
+                if len(cc_new)>1:
+                    Cls_s.append(cc_new)
                 else:
-                    Cls.append(cc)
-        if exact:
-            if verbose:
-                print(' Performing Smith-Waterman alignment')
-            Cls_s=[]
-            for cc in Cls:
-                Nc=len(cc)
-                if len(cc)<=3:
-                    sMat=np.zeros((Nc,Nc))
-                    for ii in range(Nc):
-                        s1=vss[cc[ii]]
-                        for jj in range(ii,Nc):
-                            if jj==ii:
-                                continue
-                            s2=vss[cc[jj]]
-                            if len(s1) != len(s2):
-                                continue
-                            if len(s1)<=5:
-                                continue
-                            sw=SeqComparison(s1[ST:-2],s2[ST:-2],gap=gap)
-                            sw=sw/(len(s1)-ST-2)
-                            sMat[ii,jj]=sw
-                            sMat[jj,ii]=sw
-                    s_max=[]
                     for ii in range(Nc):
-                        s_max.append(np.max(sMat[:,ii]))
-                    cc_new=[]
-                    for ii in range(Nc):
-                        if s_max[ii]>=thr_s:
-                            cc_new.append(cc[ii])
-                    if len(cc_new)>1:
-                        Cls_s.append(cc_new)
-                    else:
-                        for ii in range(Nc):
-                            uu=flagL[cc[ii]]
-                            if uu>0:
-                                Cls_s.append([cc[ii]])
-#                    print(Cls_s)
-                    Cls_sList=list(chain(*Cls_s))
-                    for ii in range(len(cc)):
                         uu=flagL[cc[ii]]
-                        if uu>0 and cc[ii] not in Cls_sList:
+                        if uu>0:
                             Cls_s.append([cc[ii]])
-                else:
-                    CDR3s=[vss[x] for x in cc]
-                    sIDs=np.array([vSD0[x] for x in cc])
-                    sIDs0=[x for x in range(len(cc))]
-                    Kset=KmerSet(CDR3s, sIDs0, KS=5, st=ST, ed=2)
-                    SSG=generateSSG(Kset, CDR3s, k_thr=1)
-                    tmpVgenes=['TRBV2']*len(CDR3s)
-                    SSGnew=UpdateSSG(SSG, CDR3s, tmpVgenes, Vscore=VDict, cutoff=thr_s+4)
-                    CLall=IdentifyMotifCluster(SSGnew)
-                    CLall_list=list(chain(*CLall))
-                    for ii in range(len(cc)):
-                        uu=flagL[cc[ii]]
-                        if uu>0 and ii not in CLall_list:
-                            CLall.append([ii])
-                    for cl in CLall:
-                        ccs=list(sIDs[np.array(cl)])
-                        Cls_s.append(ccs)
-            Cls=Cls_s
-        if verbose:
-            print(' Writing results into file')
-        for ii in range(len(Cls)):
-#            if ii % 100000 == 0 and ii>0:
-                #print('      %d sequences written' %(ii))
-            cc=Cls[ii]
-            gr+=1
-            for jj in cc:
-                for v_info in vInfo[jj]:
-                    line=vss[jj]+'\t'+str(gr)+'\t'+v_info+'\n'
-                    _=g.write(line)
-    g.close()
+#                    print(Cls_s)
+                Cls_sList=list(chain(*Cls_s))
+                for ii in range(len(cc)):
+                    uu=flagL[cc[ii]]
+                    if uu>0 and cc[ii] not in Cls_sList:
+                        Cls_s.append([cc[ii]])
+            else:
+                Cls_s+=CLallD[cc_id]
+        Cls=Cls_s
+    groups+=Cls
+    return groups
 
-def OrderUnique(Ig):
-    vv=list(Ig.values())
-    kk=list(Ig.keys())
-    LL=[len(x[1]) for x in vv]
-    v0=[x[0][0] for x in vv]
-    v1=[x[0][1] for x in vv]
-    zkk=zip(kk,v0,v1,LL)
-    zkks=sorted(zkk,key=lambda x: (x[1],x[3]))
-    nk=len(zkks)
-    keep_id=[0]
-    ii=1
-    n_pre=str(zkks[0][1])+'_'+str(zkks[0][2])
-    while ii<nk:
-        n_cur=str(zkks[ii][1])+'_'+str(zkks[ii][2])
-        if n_cur==n_pre:
-            ii+=1
-            continue
+def RefineClusterSW(cc, CDR3s, flagc, ST=3, thr_s=3.5):
+    ## Smith-Waterman refinement of one isometric cluster with more than 3 CDR3s
+    ## cc: indices of the cluster members, CDR3s: their sequences, flagc: their identical CDR3 group flags
+    ## Returns the refined sub-clusters as lists of indices from cc
+    sIDs=np.array(cc)
+    sIDs0=[x for x in range(len(cc))]
+    Kset=KmerSet(CDR3s, sIDs0, KS=5, st=ST, ed=2)
+    SSG=generateSSG(Kset, CDR3s, k_thr=1)
+    ## All V genes are set identical, so the V gene score table is not consulted
+    tmpVgenes=['TRBV2']*len(CDR3s)
+    SSGnew=UpdateSSG(SSG, CDR3s, tmpVgenes, cutoff=thr_s+4)
+    CLall=IdentifyMotifCluster(SSGnew)
+    CLall_list=set(chain(*CLall))
+    for ii in range(len(cc)):
+        uu=flagc[ii]
+        if uu>0 and ii not in CLall_list:
+            CLall.append([ii])
+    Cls_s=[]
+    for cl in CLall:
+        ccs=list(sIDs[np.array(cl)])
+        Cls_s.append(ccs)
+    return Cls_s
+
+def RefineClusterChunk(chunk, ST=3, thr_s=3.5):
+    ## Worker task: refine a chunk of (cc, CDR3s, flagc) clusters
+    return [RefineClusterSW(cc, CDR3s, flagc, ST=ST, thr_s=thr_s) for (cc, CDR3s, flagc) in chunk]
+
+def ChunkClusters(sizes, nChunks):
+    ## Group cluster indices into about nChunks chunks of similar cost, estimated as size squared.
+    ## Clusters are taken largest first, so large clusters form their own chunk and small ones are packed together.
+    cost=np.array(sizes, dtype=float)**2
+    target=cost.sum()/nChunks
+    chunks=[]
+    cur=[]
+    cur_cost=0
+    for ii in np.argsort(-cost, kind='stable'):
+        cur.append(ii)
+        cur_cost+=cost[ii]
+        if cur_cost>=target:
+            chunks.append(cur)
+            cur=[]
+            cur_cost=0
+    if len(cur)>0:
+        chunks.append(cur)
+    return chunks
+
+def RefineClusters(Cls, vss, flagL, ST=3, thr_s=3.5, pool=None, nChunks=4):
+    ## Smith-Waterman refinement of a list of clusters; returns one list of sub-clusters per input cluster
+    if pool is None or len(Cls)<2:
+        return [RefineClusterSW(cc, [vss[x] for x in cc], [flagL[x] for x in cc], ST=ST, thr_s=thr_s) for cc in Cls]
+    chunks=ChunkClusters([len(cc) for cc in Cls], nChunks)
+    jobs=[]
+    for chunk in chunks:
+        task=[(Cls[ii], [vss[x] for x in Cls[ii]], [flagL[x] for x in Cls[ii]]) for ii in chunk]
+        jobs.append(pool.apply_async(RefineClusterChunk, (task,), {'ST':ST, 'thr_s':thr_s}))
+    CLallL=[None]*len(Cls)
+    for ii in range(len(chunks)):
+        res=jobs[ii].get()
+        for jj in range(len(chunks[ii])):
+            CLallL[chunks[ii][jj]]=res[jj]
+    return CLallL
+
+def SegmentTake(off, data, idx):
+    ## Gather segments idx of a CSR layout: segment i is data[off[i]:off[i+1]]
+    lens=off[idx+1]-off[idx]
+    newOff=np.zeros(len(idx)+1, dtype=np.int64)
+    np.cumsum(lens, out=newOff[1:])
+    pos=np.repeat(off[idx]-newOff[:-1], lens)+np.arange(newOff[-1])
+    return newOff, data[pos]
+
+def SegmentLists(off, data, idx):
+    ## Segments idx of a CSR layout as Python lists
+    off, data=SegmentTake(off, data, idx)
+    off=off.tolist()
+    data=data.tolist()
+    return [data[off[ii]:off[ii+1]] for ii in range(len(off)-1)]
+
+def MergeMembers(off, data, i1, i2):
+    ## Sorted union of segments i1[k] and i2[k] of a CSR layout for each merged pair k
+    o1, d1=SegmentTake(off, data, i1)
+    o2, d2=SegmentTake(off, data, i2)
+    n=len(i1)
+    seg=np.concatenate((np.repeat(np.arange(n), np.diff(o1)), np.repeat(np.arange(n), np.diff(o2))))
+    vals=np.concatenate((d1, d2))
+    order=np.lexsort((vals, seg))
+    seg=seg[order]
+    vals=vals[order]
+    keep=np.ones(len(vals), dtype=bool)
+    keep[1:]=(seg[1:]!=seg[:-1]) | (vals[1:]!=vals[:-1])
+    newOff=np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(seg[keep], minlength=n), out=newOff[1:])
+    return newOff, vals[keep]
+
+def OrderUnique(p0, p1, LL):
+    ## Order merged pairs (p0<=p1) by p0, then by group size LL, ties in input order,
+    ## and drop a pair identical to the one right before it. Returns the positions of the kept pairs
+    order=np.lexsort((LL, p0))
+    a=p0[order]
+    b=p1[order]
+    keep=np.ones(len(order), dtype=bool)
+    keep[1:]=(a[1:]!=a[:-1]) | (b[1:]!=b[:-1])
+    return order[keep]
+
+def SameGroups(G1, G2):
+    ## Whether two rounds of ClusterCDR3 produced the same groups: same merge positions, pairs and members, in any order
+    key1, p01, p11, off1, m1=G1
+    key2, p02, p12, off2, m2=G2
+    if len(key1)!=len(key2):
+        return False
+    o1=np.argsort(key1)
+    o2=np.argsort(key2)
+    if not (np.array_equal(key1[o1], key2[o2]) and np.array_equal(p01[o1], p02[o2]) and np.array_equal(p11[o1], p12[o2])):
+        return False
+    off1, m1=SegmentTake(off1, m1, o1)
+    off2, m2=SegmentTake(off2, m2, o2)
+    return np.array_equal(off1, off2) and np.array_equal(m1, m2)
+
+def ReduceEncoding(dM, k=PCADim, pca=None):
+    ## Project encoding vectors onto their first k principal components, with the PCA fitted on dM unless given
+    ## Returns the float32 projections and the PCA, or dM itself and None if dM is too small to fit
+    if pca is None:
+        if dM.shape[0]<=k or k>=dM.shape[1]:
+            return dM, None
+        pca=PCA(n_components=k).fit(dM)
+    return np.ascontiguousarray(pca.transform(dM), dtype='float32'), pca
+
+def MakeIndex(dM, indexType='flat', GPU=False, res=None, compression='none', trained=None):
+    ## Build a faiss index of the requested type on dM and add all vectors
+    ## compression: 'sq8' or 'pq' keep quantized codes instead of float32 vectors; compressed indexes are searched on CPU
+    ## trained: optional empty compressed index already trained on similar vectors, copied instead of training again
+    d=dM.shape[1]
+    N=dM.shape[0]
+    if indexType not in IndexTypes:
+        raise ValueError("Unknown index type: "+str(indexType))
+    codec=None
+    if trained is not None and N>=ANNMinSize:
+        index = faiss.clone_index(trained)
+        index.add(dM)
+        return index
+    if compression in ['sq8','pq'] and N>=ANNMinSize:
+        codec='SQ8' if compression=='sq8' else 'PQ'+str(PQm)+'np'
+    if codec is not None:
+        if indexType=='flat':
+            index = faiss.index_factory(d, codec)
+        elif indexType=='ivf':
+            index = faiss.index_factory(d, 'IVF'+str(int(4*np.sqrt(N)))+','+codec)
+            index.nprobe=IVFnprobe
         else:
-            keep_id.append(ii)
-            n_pre=n_cur
-            ii+=1
-            continue
-    nid=[x[0] for x in zkks]
-    filtered_id=np.array(nid)[np.array(keep_id)]
-    Igs={}
-    for ii in filtered_id:
-        Igs[kk[ii]]=vv[ii]
-    return Igs, filtered_id
-
-def ClusterCDR3(dM, flagL, thr=10, GPU=False, verbose=False):
+            index = faiss.index_factory(d, 'HNSW'+str(HNSWm)+'_'+codec)
+            index.hnsw.efSearch=HNSWefSearch
+        index.train(dM)
+        GPU=False
+    elif indexType=='flat' or N<ANNMinSize:
+        index = faiss.IndexFlatL2(d)
+    elif indexType=='ivf':
+        nlist=int(4*np.sqrt(N))
+        quantizer = faiss.IndexFlatL2(d)
+        index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        index.train(dM)
+        index.nprobe=IVFnprobe
+    else:
+        index = faiss.IndexHNSWFlat(d, HNSWm)
+        index.hnsw.efSearch=HNSWefSearch
+        ## HNSW indexes have no GPU implementation
+        GPU=False
+    if GPU:
+        index = faiss.index_cpu_to_gpu(res, 0, index)
+    index.add(dM)
+    return index
+
+def MergeMeans(dM1, i1, i2, out, blockSize=4096):
+    ## out[k]=(dM1[i1[k]]+dM1[i2[k]])/2 in float32, in blocks of rows to bound the temporary arrays
+    for a in range(0, len(i1), blockSize):
+        b=min(a+blockSize, len(i1))
+        np.take(dM1, i1[a:b], axis=0, out=out[a:b])
+        out[a:b]+=dM1[i2[a:b]]
+        out[a:b]/=2
+    return out
+
+def ClusterCDR3(dM, flagL, thr=10, GPU=False, verbose=False, indexType='flat', bufDir=None, compression='none'):
     ## flagL: flag vector for identical CDR3 groups, >0 for grouped non-identical CDR3s
+    ## indexType: faiss backend used for the 2-NN searches, one of IndexTypes
+    ## compression: vector codes of the faiss index, see MakeIndex
+    ## Merged vectors of each round go into two float32 buffers allocated once; with bufDir they are memory-mapped files there,
+    ## searched in place by the exact CPU search when no faiss index needs its own copy (flat, no sq8/pq, no GPU)
+    ## Each row of dM1 is a group: position of its merge in the round (key), the merged rows of the previous round (p0<=p1)
+    ## and the absolute indices of its sequences in CSR layout (off, members)
     Cls=[]
     flag=0
     dM1=dM
     flagL=np.array(flagL)
+    res=None
+    bufMean=None
+    trained=None
+    N=dM.shape[0]
+    off=np.arange(N+1, dtype=np.int64)
+    members=np.arange(N, dtype=np.int64)
+    G=None
     if GPU:
         res = faiss.StandardGpuResources()
     while 1:
-#        print("     %d number of clusters, with %d sequences" %(len(Cls),dM1.shape[0]))
         if verbose:
             print('=',end='')
-        index = faiss.IndexFlatL2(Ndim*6)
-        if GPU:
-            index = faiss.index_cpu_to_gpu(res, 0, index)
-        index.add(dM1)
-        if flag==0:
+        if bufDir is not None and indexType=='flat' and compression not in ['sq8','pq'] and not GPU:
+            ## exact search straight on the memory-mapped vectors: an index would copy the whole bucket into faiss memory
+            D, I = faiss.knn(dM1, dM1, 2)
+        else:
+            index = MakeIndex(dM1, indexType, GPU, res, compression, trained)
+            if trained is None and compression in ['sq8','pq'] and dM1.shape[0]>=ANNMinSize:
+                ## merged vectors stay in the same space, so the quantizer trained in the first round is kept for later rounds
+                trained = faiss.clone_index(index)
+                trained.reset()
             D, I = index.search(dM1, 2)
-            vv=np.where((D[:,1]<=thr))[0]
+            del index
+        vv=np.where(D[:,1]<=thr)[0]
+        if flag==0:
             vv0=np.where((D[:,1]>thr) & (flagL>0))[0]
-            for v in vv0:
-                Cls.append([v])
-            tmp_dM=np.zeros((len(vv),Ndim*6))
-            Ig_new={}
-            for ii in range(len(vv)):
-                v=vv[ii]
-                Idx=I[v,]
-                if v not in Idx:
-                    Idx[0]=v
-                Ig_new[ii]=(sorted(list(set(Idx))),sorted(list(set(Idx))))
-                tmp_dM[ii,]=(dM1[Idx[0],]+dM1[Idx[1],])/2
-            if len(Ig_new)==0:
+            Cls+=[[v] for v in vv0.tolist()]
+            if len(vv)==0:
                 if verbose:
                     print('type 0 break')
                 break
-#                print('%d of sequence left at cycle %d' %(len(Ig_new),flag))
-            Igs, fid=OrderUnique(Ig_new)
-            tmp_dM=tmp_dM[fid,]
-            Ig_new=Igs
+            ## later rounds never have more vectors than the first
+            if bufDir is not None:
+                bufMean=MmapBuffer((len(vv), dM.shape[1]), bufDir)
+                bufCur=MmapBuffer((len(vv), dM.shape[1]), bufDir)
+            else:
+                bufMean=np.zeros((len(vv), dM.shape[1]), dtype='float32')
+                bufCur=np.zeros((len(vv), dM.shape[1]), dtype='float32')
         else:
-            D, I = index.search(dM1,2)
-            vv=np.where(D[:,1]<=thr)[0]
+            ## move groups without a close neighbour to Cls
             vv0=np.where(D[:,1]>thr)[0]
-            ## move groups in vv0 to Cls
-            kkg=list(Ig.keys())
-            for v in vv0:
-                ng=list(Ig[kkg[v]][1])
-    #            if ng not in Cls:
-                Cls.append(ng)
-            tmp_dM=np.zeros((len(vv),Ndim*6))
-            Ig_new={}
-            for ii in range(len(vv)):
-                v=vv[ii]
-                idx1=I[v,0]
-                idx2=I[v,1]
-                if v not in I[v,]:
-                    idx1=v
-#                Ig_new[ii]=sorted(list(set(list(Ig[kkg[idx1]])+list(Ig[kkg[idx2]]))))
-                Ig_new[ii]=(sorted(list(set([idx1,idx2]))),  ## First entry records the relative index of a sequence clique
-                            sorted(list(set(list(Ig[kkg[idx1]][1])+list(Ig[kkg[idx2]][1])))))  ## Second entry records the absolute index of a sequence
-                tmp_dM[ii,]=(dM1[idx1,]+dM1[idx2,])/2
-            if len(Ig_new)==0:
+            Cls+=SegmentLists(off, members, vv0)
+            if len(vv)==0:
+                ## all remaining groups were moved above
                 if verbose:
                     print("\ntype I break")
-                kkg=list(Ig.keys())
-                for kk in kkg:
-                    ng=list(Ig[kk][1])
-                    if ng not in Cls:
-                        Cls.append(ng)
-                break
-#            print('%d of sequence left at cycle %d' %(len(Ig_new),flag))
-            Igs, fid=OrderUnique(Ig_new)
-            tmp_dM=tmp_dM[fid,]
-            Ig_new=Igs
-        if flag>0:
-            if Ig == Ig_new:
-                if verbose:
-                    print("\ntype II break")
-                kkg=list(Ig.keys())
-                for kk in kkg:
-                    ng=list(Ig[kk][1])
-                    if ng in Cls:
-                        continue
-                    Cls.append(ng)
                 break
-        Ig=Ig_new
-        tmp_dM=tmp_dM.astype('float32')
+        ## a vector missing from its own 2 nearest neighbours is merged with the second one
+        Iv=I[vv]
+        i1=np.where((Iv[:,0]==vv) | (Iv[:,1]==vv), Iv[:,0], vv)
+        i2=Iv[:,1]
+        p0=np.minimum(i1, i2)
+        p1=np.maximum(i1, i2)
+        offN, membersN=MergeMembers(off, members, i1, i2)
+        ## dM1 is no longer needed once the means are taken, so the reordered vectors can overwrite it
+        tmp_dM=MergeMeans(dM1, i1, i2, bufMean[:len(vv)])
+        fid=OrderUnique(p0, p1, np.diff(offN))
+        tmp_dM=np.take(tmp_dM, fid, axis=0, out=bufCur[:len(fid)])
+        offN, membersN=SegmentTake(offN, membersN, fid)
+        G_new=(fid, p0[fid], p1[fid], offN, membersN)
+        if G is not None and SameGroups(G, G_new):
+            if verbose:
+                print("\ntype II break")
+            seen=set(map(tuple, Cls))
+            for ng in SegmentLists(off, members, np.arange(len(off)-1)):
+                if tuple(ng) in seen:
+                    continue
+                seen.add(tuple(ng))
+                Cls.append(ng)
+            break
+        G=G_new
+        off=offN
+        members=membersN
         dM1=tmp_dM
         flag+=1
     return Cls
 
+def ClusterLabels(Cls, N):
+    ## Convert a cluster list into a label vector; sequences outside all clusters get their own label
+    labels=-np.arange(1, N+1)
+    for ii in range(len(Cls)):
+        labels[np.array(Cls[ii], dtype=np.int64)]=ii
+    return labels
+
+def ClusterConcordance(Cls1, Cls2, N):
+    ## Agreement between two clusterings of the same N sequences:
+    ## adjusted Rand index of the labels and fraction of multi-member clusters in Cls1 reproduced exactly in Cls2
+    ari=adjusted_rand_score(ClusterLabels(Cls1, N), ClusterLabels(Cls2, N))
+    Cls1m=[tuple(sorted(x)) for x in Cls1 if len(x)>1]
+    Cls2m=set([tuple(sorted(x)) for x in Cls2 if len(x)>1])
+    exact=np.mean([x in Cls2m for x in Cls1m]) if len(Cls1m)>0 else 1.0
+    return ari, exact
+
+def IndexAgreementReport(dM, flagL, thr=10, indexType='hnsw', Cls=None, t_index=None, GPU=False, compression='none', compressDim=PCADim):
+    ## Compare an approximate or compressed index with the exact flat index on full vectors for one length bucket:
+    ## 2-NN recall on the initial search, index memory, cluster agreement of ClusterCDR3 and run time of both
+    ## Cls and t_index can be given to reuse a clustering already computed with indexType and compression
+    N=dM.shape[0]
+    res=faiss.StandardGpuResources() if GPU else None
+    dMc=dM
+    if compression=='pca':
+        dMc, _ = ReduceEncoding(dM, compressDim)
+    index0=MakeIndex(dM, 'flat', GPU, res)
+    index1=MakeIndex(dMc, indexType, GPU, res, compression)
+    D0, I0 = index0.search(dM, 2)
+    D1, I1 = index1.search(dMc, 2)
+    mem0=len(faiss.serialize_index(index0 if not GPU else faiss.index_gpu_to_cpu(index0)))
+    mem1=len(faiss.serialize_index(index1 if not GPU or compression in ['sq8','pq'] else faiss.index_gpu_to_cpu(index1)))
+    del index0, index1
+    ## A neighbor is recalled if the one found is at the exact nearest neighbor distance in the full space (ties are common)
+    D1t=((dM-dM[np.maximum(I1[:,1],0)])**2).sum(axis=1)
+    recall=np.mean(np.abs(D0[:,1]-D1t)<=1e-4*np.maximum(1,D0[:,1]))
+    t1=time.time()
+    Cls0=ClusterCDR3(dM, flagL, thr=thr, GPU=GPU, indexType='flat')
+    t2=time.time()
+    if Cls is None:
+        Cls=ClusterCDR3(dMc, flagL, thr=thr, GPU=GPU, indexType=indexType, compression=compression)
+        t_index=time.time()-t2
+    ari, exact=ClusterConcordance(Cls0, Cls, N)
+    name=indexType if compression=='none' else indexType+'+'+compression
+    print("     Index %s vs flat: N=%d, 2-NN recall %.4f, cluster ARI %.4f, exact clusters %.4f, flat time %f, %s time %f, index memory %.2f MB vs %.2f MB (%.2f MB saved)"
+          %(name, N, recall, ari, exact, t2-t1, name, t_index, mem1/1e6, mem0/1e6, (mem0-mem1)/1e6))
+    return {'N':N, 'recall':recall, 'ARI':ari, 'exact':exact, 't_flat':t2-t1, 't_index':t_index, 'mem_flat':mem0, 'mem_index':mem1}
+
+def CSRNeighbors(lims, I, rows):
+    ## Unique neighbors of a set of rows in a faiss range_search result (lims, I form a CSR adjacency)
+    rows=np.asarray(rows, dtype=np.int64)
+    st=lims[rows]
+    ln=lims[rows+1]-st
+    tot=int(ln.sum())
+    if tot==0:
+        return np.zeros(0, dtype=np.int64)
+    ## position of each neighbor in I: start of its row plus its offset within the row
+    offs=np.repeat(st-(np.cumsum(ln)-ln), ln)+np.arange(tot)
+    return np.unique(I[offs])
+
 def ClusterCDR3r(dM, flagL, thr = 10, verbose = False):
-    index = faiss.IndexFlatL2(Ndim*6)
+    ## Range search clustering: a single range_search with radius thr, followed by a breadth-first
+    ## assignment starting from the sequence with most neighbors. Expansion restarts a new cluster after 4 levels.
+    ## Unlike ClusterCDR3, every sequence is returned in exactly one cluster, including singletons.
+    index = faiss.IndexFlatL2(dM.shape[1])
     index.add(dM)
     lims, D, I = index.range_search(dM, thr)
-    # with open('cdr3.npy', 'wb') as f:
-    #     np.save(f, lims)
-    #     np.save(f, D)
-    #     np.save(f, I)
-    #     np.save(f, dM)
-    
-    # now clustering results
+    lims = lims.astype(np.int64)
     N = dM.shape[0]
-    neighborSize = np.array([lims[cur_idx_i+1] - lims[cur_idx_i] for cur_idx_i in range(N)])
-    # to_cluster = np.ones( (N,))
+    neighborSize = np.diff(lims)
     clusterNo = 0
     cluster = - np.ones( (N, ),  dtype = np.int32)
-    idx = np.where(cluster < 0)[0]
-    unclustered = [np.argmax(neighborSize[idx])]
+    ## seeds are taken in decreasing order of neighbor count (first index on ties, as np.argmax)
+    seedOrder = np.argsort(-neighborSize, kind='stable')
+    seedPos = 0
+    unclustered = [seedOrder[0]]
     depth = 0
     while True:
         if len(unclustered) == 0: break
-        # cur_idx = unclustered[0] # first unclustered index
         cur_idx = unclustered
         cluster[cur_idx] = clusterNo # assign cluster
-   
-        neighbor = np.unique(np.array(list(chain (* [I[(lims[cur_idx_i]): lims[cur_idx_i+1]] for cur_idx_i in cur_idx]))))
+        neighbor = CSRNeighbors(lims, I, cur_idx)
         # find those unclusterred
         idx = np.where(cluster[neighbor] < 0)[0]
         if len(idx) == 0:
             depth = 0
             clusterNo += 1
-            idx = np.where(cluster < 0)[0]
-            if len(idx) == 0: break
-            unclustered = [idx[np.argmax(neighborSize[idx])]]
-           
+            while seedPos < N and cluster[seedOrder[seedPos]] >= 0:
+                seedPos += 1
+            if seedPos == N: break
+            unclustered = [seedOrder[seedPos]]
         else:
             if depth > 3:
                 depth = 0
                 clusterNo += 1
             unclustered = neighbor[idx]
             depth += 1
-#    print('clusterNo = ', clusterNo)
-    Cls = [ [] for i in range(clusterNo)]
-    for idx, i in enumerate(cluster):
-            Cls[i].append(idx)
-#    print("Cls[:5] = ", Cls[:5])
-#    print("len(Cls) = ", len(Cls),
-#          ', #elem=', sum([len(i) for i in Cls]),
-#          ', #single=', sum([len(i) for i in Cls if len(i) == 1]),
-#          ', #non_single=', sum([len(i) for i in Cls if len(i) != 1]),          
-#          ', #max=', max([len(i) for i in Cls]))
+    if verbose:
+        print('     %d clusters from range search' %(clusterNo))
+    ## group sequence indices by cluster number, keeping increasing order within each cluster
+    order = np.argsort(cluster, kind='stable')
+    bounds = np.cumsum(np.bincount(cluster, minlength=clusterNo))[:-1]
+    Cls = [x.tolist() for x in np.split(order, bounds)]
     return Cls
 
 def CommandLineParser():
@@ -1081,12 +2175,25 @@ Input columns:
     parser.add_option("-g","--GapPenalty",dest="Gap",default= -6,help="Gap penalty,default= -6")
     parser.add_option("-n","--GapNumber",dest="GapN",default=1,help="Maximum number of gaps allowed when performing alignment. Max=1, default=1")
     parser.add_option("-V","--VariableGeneFa",dest="VFa",default="Imgt_Human_TRBV.fasta",help="IMGT Human beta variable gene sequences")
+    parser.add_option("-B","--rebuildVgeneCache",dest="VRebuild",default=False,action="store_true",help="Recompute the cached V gene score table of the -V FASTA file.")
     parser.add_option("-v","--VariableGene",dest="V",default=True,action="store_false",help="If False, iSMART will omit variable gene information and use CDR3 sequences only. This will yield reduced specificity. The cut-off will automatically become the current value-4.0")
     parser.add_option("-e","--Exact",dest="E",default=True,action="store_false",help="If False, iSMART will not perform Smith-Waterman alignment after isometric encoding.")
-    parser.add_option("-N","--NumberOfThreads",dest="NN",default=1,help="Number of threads for multiple processing. Not working so well.")
+    parser.add_option("-N","--NumberOfThreads",dest="NN",default=1,help="Number of OpenMP threads used by faiss in each process.")
+    parser.add_option("-P","--NumberOfProcesses",dest="NP",default=1,help="Number of worker processes. CDR3 length buckets are clustered in parallel, largest first. Default 1.")
+    parser.add_option("-W","--SWProcesses",dest="NW",default=1,help="Number of worker processes for Smith-Waterman refinement of large clusters. Used when -P is 1. Default 1.")
     parser.add_option("-U","--UseGPU",dest="GPU", default=False, action="store_true",help="Use GPU for Faiss indexing. Must be CUDA GPUs.")
     parser.add_option("-q","--queryFile",dest="Query",default='',help="Input query file, if given, GIANA will run in query mode, also need to provide -r option.")
     parser.add_option("-r","--refFile",dest="ref", default='',help="Input reference file. Query model required.")
+    parser.add_option("-c","--embeddingStore",dest="EmbedDB",default='',help="Directory of a persistent CDR3 embedding store. If given, encoded CDR3s are reused across runs and new ones are appended. Concurrent runs can share a store: appends are serialized with a file lock.")
+    parser.add_option("-i","--indexType",dest="Index",default="flat",help="Faiss index used for isometric clustering: flat (exact, default), ivf or hnsw (approximate, on length buckets with at least 5000 unique CDR3s). Approximate indexes miss few nearest neighbors, but the iterative merge amplifies them: on the Control data hnsw clusters of 14000-37000 CDR3 buckets have ARI 0.55-0.86 against flat at 0.5-0.7x its run time. Check with -R before relying on them.")
+    parser.add_option("-m","--clusterMode",dest="Mode",default="merge",help="Isometric clustering algorithm: merge (iterative nearest neighbor merging, default) or range (single range search with breadth-first assignment, flat index only, without -R).")
+    parser.add_option("-s","--streaming",dest="Stream",default=False,action="store_true",help="Read the input in chunks and spill each CDR3 length bucket to a temporary file. Peak memory is bounded by the largest length bucket.")
+    parser.add_option("-M","--mmapDir",dest="MmapDir",default=None,help="Directory for memory-mapped float32 encoding matrices and merge buffers of length buckets with at least 100000 unique CDR3s. Merge clustering with the flat index and no sq8/pq compression searches these files in place; other indexes, sq8/pq, GPU and range clustering still keep a full copy of the bucket in faiss memory.")
+    parser.add_option("-z","--compression",dest="Compression",default="none",help="Experimental compression of the CDR3 encoding vectors: none (default), pca (project to -k dimensions), sq8 (8-bit scalar quantization) or pq (product quantization). sq8 and pq only apply to length buckets with at least 5000 unique CDR3s. Clusters differ from none: on the Control data, buckets of 14000-37000 CDR3s had ARI 0.38-0.60 with pca, which keeps the -t threshold on shrunken distances and over-merges, 0.57-0.80 with sq8 and 0.41-0.88 with pq, which is also 1.6-6x slower than none. Check with -R.")
+    parser.add_option("-k","--PCADim",dest="PCADim",default=PCADim,help="Number of dimensions kept by -z pca. Default 64.")
+    parser.add_option("-R","--indexReport",dest="IndexReport",default=False,action="store_true",help="With an approximate -i index or -z compression, report 2-NN recall, index memory and cluster agreement against the uncompressed flat index for each length bucket.")
+    parser.add_option("-C","--columnar",dest="Columnar",default=False,action="store_true",help="Also write the clustering output as a columnar .npz file (CDR3, cluster, Vgene, sample, info and length columns) next to the text output. AutoCAT and query mode load it instead of the text file when present.")
+    parser.add_option("-L","--sampleLabels",dest="Labels",default='',help="CSV file of sample names and integer labels, such as labels.csv of AutoCAT. If given, the size, CDR3 length and label counts of each cluster are saved in a .composition.npz file next to the output. The sample of a sequence is its last column.")
     parser.add_option("-b","--Verbose", dest='v', default=False, action="store_true", help="Verbose option: if given, GIANA will print intermediate messages.")
     return parser.parse_args()
 
@@ -1095,10 +2202,14 @@ def main():
     cutoff=float(opt.thr)
     OutDir=opt.OutDir
     thr_s=float(opt.thr_s)
+    eStore=None
+    if len(opt.EmbedDB)>0:
+        eStore=EmbeddingStore(opt.EmbedDB, ST=int(opt.ST))
     ## Check if query mode first
     qFile=opt.Query
     if len(qFile)>0:
-        ## query mode
+        ## query mode; query.py imports from this module, so it is loaded only here
+        from query import CreateReference, MakeQuery, MergeExist
         t1=time.time()
         if qFile.endswith('/'):
             ## input query is a directory
@@ -1117,7 +2228,7 @@ def main():
             refClusterFile=rFile0+'--RotationEncodingBL62.txt'
             if not os.path.exists(refClusterFile):
                 raise("Must run clustering on reference file first! Did you forget to put the clustering file in this directory?")
-            rData=CreateReference(rFile)
+            rData=CreateReference(rFile, eStore=eStore, compression=opt.Compression, compressDim=int(opt.PCADim))
             t2=time.time()
             print("Reference created. Elapsed %f" %(t2-t1))
             for qf in qFileList:
@@ -1129,7 +2240,7 @@ def main():
                 if path.exists(of):
                     print(of+' already exits. Skipping.')
                     continue
-                MakeQuery(qf, rData, thr=cutoff, thr_s=thr_s)
+                MakeQuery(qf, rData, thr=cutoff, thr_s=thr_s, eStore=eStore)
                 t2=time.time()
                 print("     Build query clustering file. Elapsed %f" %(t2-t1))
                 print("Now mering with reference cluster")
@@ -1158,22 +2269,16 @@ def main():
                 for ff in fL.readlines():
                         files.append(ff.strip())
         VFa=opt.VFa
-        PreCalculateVgeneDist(VFa)
-        vf=open('./VgeneScores.txt')  ## Use tcrDist's Vgene 80-score calculation
-        VScore={}
         VV=opt.V
         EE=opt.E
         ST=int(opt.ST)
         thr_v=float(opt.thr_v)
         verbose=opt.v
         if VV:
-            while 1:
-                line=vf.readline()
-                if len(line)==0:
-                    break
-                ww=line.strip().split('\t')
-                VScore[(ww[0],ww[1])]=int(ww[2])/20
-                VScore[(ww[1],ww[0])]=int(ww[2])/20
+            ## Use tcrDist's Vgene 80-score calculation, cached per V gene FASTA
+            VIndex, VCompat = LoadVgeneCompatibility(VFa, thr_v, rebuild=opt.VRebuild)
+        else:
+            VIndex, VCompat = None, None
         Gap=int(opt.Gap)
         Gapn=int(opt.GapN)
         OutFile=opt.OutFile
@@ -1182,10 +2287,13 @@ def main():
         ed=1
         NT=int(opt.NN)
         faiss.omp_set_num_threads(NT)
+        sampleLabels=LoadSampleLabels(opt.Labels) if len(opt.Labels)>0 else None
         for ff in files:
             print("Processing %s" %ff)
-            EncodeRepertoire(ff, OutDir, OutFile, ST=ST, thr_s=thr_s, thr_v=thr_v, exact=EE,VDict=VScore, Vgene=VV, thr_iso=cutoff, gap=Gap, GPU=GPU, verbose=verbose)
-        
+            EncodeRepertoire(ff, OutDir, OutFile, ST=ST, thr_s=thr_s, thr_v=thr_v, exact=EE, Vgene=VV, thr_iso=cutoff, gap=Gap, GPU=GPU, verbose=verbose, eStore=eStore, indexType=opt.Index, indexReport=opt.IndexReport, clusterMode=opt.Mode, nProc=int(opt.NP), swProc=int(opt.NW), VIndex=VIndex, VCompat=VCompat, streaming=opt.Stream, mmapDir=opt.MmapDir, compression=opt.Compression, compressDim=int(opt.PCADim), columnar=opt.Columnar, sampleLabels=sampleLabels)
+    if eStore is not None:
+        eStore.Report()
+
 if __name__ == "__main__":
     t0=time.time()
     main()
@@ -0,0 +1,252 @@
+## Benchmarks of GIANA components on the bundled training data
+## Usage: python benchmark.py -t encoding|index|range|align|pairs|kmer|compress [-d trainingData/Control/ -n 4]
+
+import os, time, random, multiprocessing
+import numpy as np
+from optparse import OptionParser
+from GIANA4 import *
+
+def LoadBenchmarkData(FileDir='trainingData/Control/', nFiles=4):
+    ## Collect CDR3s and V genes from the first nFiles sample files of the bundled data
+    files=sorted(os.listdir(FileDir))[:nFiles]
+    seqs=[]
+    vgs=[]
+    infoList=[]
+    for ff in files:
+        h=open(FileDir+'/'+ff)
+        for ll in h.readlines()[1:]:
+            ww=ll.strip().split('\t')
+            cdr3=ww[0]
+            if '*' in cdr3 or '_' in cdr3:
+                continue
+            seqs.append(cdr3)
+            vgs.append(ww[1])
+            infoList.append('\t'.join(ww[1:]))
+        h.close()
+    LD,VD, ID,SD= BuildLengthDict(seqs, vGene=vgs,INFO=infoList,sIDs=[x for x in range(len(seqs))])
+    return CollapseUnique(LD, VD, ID, SD)
+
+def BenchmarkEncoding(LDu, SDu, ST=3):
+    ## Compare per-sequence EncodingCDR3 calls with the batch encoder for each length bucket
+    print("Length\tN\tEncodingCDR3 (s)\tEncodingCDR3Batch (s)\tSpeedup\tMax abs diff")
+    t_old=0
+    t_new=0
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        t1=time.time()
+        dM0=np.array([EncodingCDR3(x[ST:-2], M6, n0) for x in vss]).astype("float32")
+        t2=time.time()
+        dM1=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        t3=time.time()
+        t_old+=t2-t1
+        t_new+=t3-t2
+        print("%d\t%d\t%f\t%f\t%.1f\t%g" %(kk, len(vss), t2-t1, t3-t2, (t2-t1)/max(t3-t2,1e-9), np.max(np.abs(dM0-dM1))))
+    print("Total\t\t%f\t%f\t%.1f" %(t_old, t_new, t_old/max(t_new,1e-9)))
+
+def BenchmarkIndex(LDu, SDu, IDu, ST=3, thr_iso=7, indexTypes=['ivf','hnsw']):
+    ## Run the flat vs approximate index agreement report of ClusterCDR3 for each length bucket
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        flagL=[len(x)-1 for x in IDu[kk]]
+        dM=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        print("Length %d" %kk)
+        for indexType in indexTypes:
+            IndexAgreementReport(dM, flagL, thr=thr_iso - 0.5*(15-kk), indexType=indexType)
+
+def BenchmarkCompression(LDu, SDu, IDu, ST=3, thr_iso=7, compressions=['pca','sq8','pq']):
+    ## Run the compressed vs uncompressed flat index agreement and memory report of ClusterCDR3 for each length bucket
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        flagL=[len(x)-1 for x in IDu[kk]]
+        dM=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        print("Length %d" %kk)
+        for compression in compressions:
+            IndexAgreementReport(dM, flagL, thr=thr_iso - 0.5*(15-kk), indexType='flat', compression=compression)
+
+def MemoryStatus(field):
+    ## Memory field (VmRSS, VmHWM) of /proc/self/status in MB
+    with open('/proc/self/status') as h:
+        for ll in h:
+            if ll.startswith(field+':'):
+                return int(ll.split()[1])/1e3
+
+def ProfileWorker(funcName, args, kwargs, conn):
+    rss0=MemoryStatus('VmRSS')
+    t1=time.time()
+    res=globals()[funcName](*args, **kwargs)
+    t2=time.time()
+    ## VmHWM is the peak RSS of this process only; ru_maxrss would also carry over the parent's peak through fork and exec
+    conn.send((res, t2-t1, rss0, MemoryStatus('VmHWM')))
+    conn.close()
+
+def ProfileCall(func, *args, **kwargs):
+    ## Run func in a freshly spawned process and return its result, wall time, the RSS of the process before the call
+    ## and its peak RSS (MB). Unlike tracemalloc, RSS includes faiss indexes, search buffers and mapped pages
+    ctx=multiprocessing.get_context('spawn')
+    parentConn, childConn=ctx.Pipe(duplex=False)
+    p=ctx.Process(target=ProfileWorker, args=(func.__name__, args, kwargs, childConn))
+    p.start()
+    childConn.close()
+    res=parentConn.recv()
+    p.join()
+    return res
+
+def BenchmarkRange(LDu, SDu, IDu, ST=3, thr_iso=7):
+    ## Compare the range search clustering ClusterCDR3r with the merge clustering ClusterCDR3 for each length bucket
+    print("Length\tN\tmerge time (s)\trange time (s)\tbase RSS (MB)\tmerge peak RSS (MB)\trange peak RSS (MB)\tARI\tExact clusters")
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        flagL=[len(x)-1 for x in IDu[kk]]
+        dM=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        thr=thr_iso - 0.5*(15-kk)
+        Cls0, t0, b0, m0 = ProfileCall(ClusterCDR3, dM, flagL, thr=thr)
+        Cls1, t1, b1, m1 = ProfileCall(ClusterCDR3r, dM, flagL, thr=thr)
+        ari, exact = ClusterConcordance(Cls0, Cls1, dM.shape[0])
+        print("%d\t%d\t%f\t%f\t%.1f\t%.1f\t%.1f\t%.4f\t%.4f" %(kk, dM.shape[0], t0, t1, max(b0, b1), m0, m1, ari, exact))
+
+def BenchmarkAlignment(SDu, ST=3, nPairs=100000, gap=-6, seed=1):
+    ## Compare NHLocalAlignment with NHLocalAlignmentBatch on random pairs of CDR3s whose lengths differ by at most 1
+    random.seed(seed)
+    LLs=sorted(SDu)
+    Seqs1=[]
+    Seqs2=[]
+    for ii in range(nPairs):
+        L=random.choice(LLs)
+        L2=random.choice([x for x in [L-1,L,L+1] if x in SDu])
+        Seqs1.append(random.choice(SDu[L])[ST:-2])
+        Seqs2.append(random.choice(SDu[L2])[ST:-2])
+    t1=time.time()
+    s0=[NHLocalAlignment(Seqs1[ii], Seqs2[ii], 1, gap) for ii in range(nPairs)]
+    t2=time.time()
+    s1=NHLocalAlignmentBatch(Seqs1, Seqs2, 1, gap)
+    t3=time.time()
+    print("Pairs\tNHLocalAlignment (s)\tNHLocalAlignmentBatch (s)\tSpeedup\tMismatches")
+    print("%d\t%f\t%f\t%.1f\t%d" %(nPairs, t2-t1, t3-t2, (t2-t1)/max(t3-t2,1e-9), np.sum(np.array(s0)!=s1)))
+
+def VgeneScoreDict():
+    ## V gene score table as the (V1, V2) keyed dictionary used by falign
+    Vnames, VMat = LoadVgeneScores()
+    n=len(Vnames)
+    return {(Vnames[ii],Vnames[jj]):VMat[ii,jj] for ii in range(n) for jj in range(n)}
+
+def CollectSSGPairs(LDu, VDu, IDu, SDu, ST=3, thr_iso=7, minSize=4):
+    ## Candidate pairs of the sequence share graphs built for SW refinement of isometric clusters
+    CDR3L=[]
+    VgeneL=[]
+    SSGL=[]
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        flagL=[len(x)-1 for x in IDu[kk]]
+        dM=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        for cc in ClusterCDR3(dM, flagL, thr=thr_iso - 0.5*(15-kk)):
+            if len(cc)<minSize:
+                continue
+            CDR3s=[vss[x] for x in cc]
+            Kset=KmerSet(CDR3s, [x for x in range(len(cc))], KS=5, st=ST, ed=2)
+            CDR3L.append(CDR3s)
+            VgeneL.append([VDu[kk][x] for x in cc])
+            SSGL.append(generateSSG(Kset, CDR3s, k_thr=1))
+    return CDR3L, VgeneL, SSGL
+
+def BenchmarkPairs(LDu, VDu, IDu, SDu, ST=3, cutoff=7.5):
+    ## Compare per-pair falign calls with the batch ScorePairs on SSG candidate pairs, using the real V genes
+    VScore=VgeneScoreDict()
+    CDR3L, VgeneL, SSGL = CollectSSGPairs(LDu, VDu, IDu, SDu, ST=ST)
+    nPairs=0
+    nDiff=0
+    t_old=0
+    t_new=0
+    for ii in range(len(SSGL)):
+        SSG=SSGL[ii]
+        CDR3s=CDR3L[ii]
+        Vgenes=VgeneL[ii]
+        II=[]
+        JJ=[]
+        for kk in SSG:
+            for vv in SSG[kk]:
+                II.append(kk)
+                JJ.append(vv)
+        t1=time.time()
+        keep0=[falign(CDR3s[II[x]], CDR3s[JJ[x]], Vgenes[II[x]], Vgenes[JJ[x]], st=ST, VScore=VScore)>=cutoff for x in range(len(II))]
+        t2=time.time()
+        keep1=ScorePairs(II, JJ, CDR3s, Vgenes, Vscore=VScore, cutoff=cutoff, st=ST)
+        t3=time.time()
+        t_old+=t2-t1
+        t_new+=t3-t2
+        nPairs+=len(II)
+        nDiff+=np.sum(np.array(keep0, dtype=bool)!=keep1)
+    print("Clusters\tPairs\tfalign (s)\tScorePairs (s)\tSpeedup\tMismatches")
+    print("%d\t%d\t%f\t%f\t%.1f\t%d" %(len(SSGL), nPairs, t_old, t_new, t_old/max(t_new,1e-9), nDiff))
+
+def KmerIndexEnumerate(Kset, nMismatch=1):
+    ## Reference K-mer index built by enumerating all mismatched strings of each K-mer
+    KKs_set=set(Kset.KD.keys())
+    KI_Dict={}
+    for kk in KKs_set:
+        if nMismatch==1:
+            KS_n=set(Kset.FindKmerNeighbor(kk))
+        else:
+            KS_n=set(Kset.FindKmerNeighbor2(kk))
+        KI_Dict[kk]=list(KS_n & KKs_set)
+    return KI_Dict
+
+def BenchmarkKmer(LDu, IDu, SDu, ST=3, thr_iso=7, minSize=100):
+    ## Compare the enumeration K-mer index with the masked-position hash index on the large candidate clusters
+    KsetL=[]
+    for kk in sorted(LDu):
+        vss=SDu[kk]
+        flagL=[len(x)-1 for x in IDu[kk]]
+        dM=EncodingCDR3Batch([x[ST:-2] for x in vss], M6, n0)
+        for cc in ClusterCDR3(dM, flagL, thr=thr_iso - 0.5*(15-kk)):
+            if len(cc)<minSize:
+                continue
+            KsetL.append(KmerSet([vss[x] for x in cc], [x for x in range(len(cc))], KS=5, st=ST, ed=2))
+    print("Mismatches\tClusters\tK-mers\tEnumeration (s)\tHash index (s)\tSpeedup\tMismatched K-mers")
+    for nMismatch in [1,2]:
+        t_old=0
+        t_new=0
+        nK=0
+        nDiff=0
+        for Kset in KsetL:
+            t1=time.time()
+            KI0=KmerIndexEnumerate(Kset, nMismatch)
+            t2=time.time()
+            KI1=Kset.KmerIndex(nMismatch)
+            t3=time.time()
+            t_old+=t2-t1
+            t_new+=t3-t2
+            nK+=len(KI0)
+            nDiff+=sum([set(KI0[x])!=set(KI1[x]) for x in KI0])
+        print("%d\t%d\t%d\t%f\t%f\t%.1f\t%d" %(nMismatch, len(KsetL), nK, t_old, t_new, t_old/max(t_new,1e-9), nDiff))
+
+def CommandLineParser():
+    parser=OptionParser()
+    parser.add_option("-t","--test",dest="Test",default="encoding",help="Benchmark to run: encoding, index, range, align, pairs, kmer, compress")
+    parser.add_option("-d","--directory",dest="Directory",default="trainingData/Control/",help="Directory of sample files used as benchmark input")
+    parser.add_option("-n","--nFiles",dest="nFiles",default=4,help="Number of sample files loaded from the directory")
+    parser.add_option("-T","--startPosition",dest='ST',default=3,help="Starting position of CDR3 sequence")
+    return parser.parse_args()
+
+def main():
+    (opt,_)=CommandLineParser()
+    ST=int(opt.ST)
+    LDu, VDu, IDu, SDu = LoadBenchmarkData(opt.Directory, int(opt.nFiles))
+    if opt.Test=='encoding':
+        BenchmarkEncoding(LDu, SDu, ST=ST)
+    elif opt.Test=='index':
+        BenchmarkIndex(LDu, SDu, IDu, ST=ST)
+    elif opt.Test=='range':
+        BenchmarkRange(LDu, SDu, IDu, ST=ST)
+    elif opt.Test=='align':
+        BenchmarkAlignment(SDu, ST=ST)
+    elif opt.Test=='pairs':
+        BenchmarkPairs(LDu, VDu, IDu, SDu, ST=ST)
+    elif opt.Test=='compress':
+        BenchmarkCompression(LDu, SDu, IDu, ST=ST)
+    elif opt.Test=='kmer':
+        BenchmarkKmer(LDu, IDu, SDu, ST=ST)
+    else:
+        print("Unknown benchmark: "+opt.Test)
+
+if __name__ == "__main__":
+    main()
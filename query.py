@@ -1,12 +1,17 @@
 ## Query mode of GIANA, to be loaded by GIANA, cannot run alone
 
 import shelve
+import io
 import subprocess as sp
 import pandas as pd
-from GIANA4 import *
+import numpy as np
+import faiss
+from GIANA4 import ANNMinSize, PCADim, BuildLengthDict, CollapseUnique, EncodeCDR3List, ReduceEncoding, MakeIndex, LoadClusterColumns
 
-def CreateReference(rFile, outdir='./', Vgene=True, ST=3):
+def CreateReference(rFile, outdir='./', Vgene=True, ST=3, eStore=None, compression='none', compressDim=None):
     ## convert input reference file into a python workplace
+    ## compression: 'pca' keeps the reference vectors projected to compressDim (default PCADim) dimensions, 'sq8' or 'pq' keep
+    ## them as quantized codes in a faiss index. Queries are compressed the same way in MakeQuery.
     h=open(rFile)
     alines=h.readlines()
     ww=alines[0].strip().split('\t')
@@ -39,16 +44,28 @@ def CreateReference(rFile, outdir='./', Vgene=True, ST=3):
         count+=1
     LD,VD, ID,SD= BuildLengthDict(seqs, vGene=vgs,INFO=infoList,sIDs=[x for x in range(len(seqs))])
     LDu_r, VDu_r, IDu_r, SDu_r = CollapseUnique(LD, VD, ID, SD)
+    if compressDim is None:
+        compressDim=PCADim
     flagLD_r={}
     dMD_r={}
+    cmpD_r={}
+    mem0=0
+    mem1=0
     for kk in LDu_r:
         vss=SDu_r[kk]
         vInfo=IDu_r[kk]
         flagL=[len(x)-1 for x in vInfo]
         flagLD_r[kk]=flagL
-        dM=np.array([EncodingCDR3(x[ST:-2], M6, n0) for x in vss])
-        dM=dM.astype("float32")        
+        dM=EncodeCDR3List(vss, ST, eStore)
+        mem0+=dM.nbytes
+        if compression=='pca':
+            dM, cmpD_r[kk] = ReduceEncoding(dM, compressDim)
+        elif compression in ['sq8','pq'] and dM.shape[0]>=ANNMinSize:
+            dM=MakeIndex(dM, 'flat', compression=compression)
         dMD_r[kk]=dM
+        mem1+=dM.nbytes if isinstance(dM, np.ndarray) else len(faiss.serialize_index(dM))
+    if compression!='none':
+        print("     Reference vectors: %.2f MB with %s compression, %.2f MB uncompressed" %(mem1/1e6, compression, mem0/1e6))
 ##    ff0=re.sub('.txt','',rFile)
 ##    outfile=outdir+ff0+'_giana_ref.shelve'
 ##    giana_shelf = shelve.open(outfile, 'n')
@@ -59,9 +76,10 @@ def CreateReference(rFile, outdir='./', Vgene=True, ST=3):
 ##    giana_shelf['IDu']=IDu_r
 ##    giana_shelf['SDu']=SDu_r
 ##    giana_shelf.close()
-    return [LDu_r, VDu_r, IDu_r, SDu_r, dMD_r]
+    return [LDu_r, VDu_r, IDu_r, SDu_r, dMD_r, cmpD_r]
 
-def MakeQuery(qFile, rData=[],dbFile=None, Vgene=True, thr=7, ST=3, thr_s=3.3):
+def MakeQuery(qFile, rData=[],dbFile=None, Vgene=True, thr=7, ST=3, thr_s=3.3, eStore=None):
+    cmpD_r={}
     if dbFile is not None:
         with shelve.open(dbFile) as db:
             for key in db:
@@ -74,6 +92,8 @@ def MakeQuery(qFile, rData=[],dbFile=None, Vgene=True, thr=7, ST=3, thr_s=3.3):
         IDu_r=rData[2]
         SDu_r=rData[3]
         dMD_r=rData[4]
+        if len(rData)>5:
+            cmpD_r=rData[5]
     h=open(qFile)
     alines=h.readlines()
     ww=alines[0].strip().split('\t')
@@ -115,16 +135,25 @@ def MakeQuery(qFile, rData=[],dbFile=None, Vgene=True, thr=7, ST=3, thr_s=3.3):
         vInfo_r=IDu_r[kk]
         flagL=[len(x)-1 for x in vInfo]
         dM_r=dMD_r[kk]
-        dM=np.array([EncodingCDR3(x[ST:-2], M6, n0) for x in vss])
-        dM=dM.astype("float32")
+        dM=EncodeCDR3List(vss, ST, eStore)
+        if cmpD_r.get(kk) is not None:
+            dM, _ = ReduceEncoding(dM, pca=cmpD_r[kk])
         nq=dM.shape[0]
-        nr=dM_r.shape[0]
         vssc=vss+vss_r
         vInfoc=vInfo+vInfo_r
-        dMc=np.concatenate((dM, dM_r))
-        index = faiss.IndexFlatL2(Ndim*6)
-        index.add(dMc)
-        D, I = index.search(dM, 2)
+        if isinstance(dM_r, np.ndarray):
+            nr=dM_r.shape[0]
+            dMc=np.concatenate((dM, dM_r))
+            index = faiss.IndexFlatL2(dMc.shape[1])
+            index.add(dMc)
+            D, I = index.search(dM, 2)
+        else:
+            ## Quantized reference: query vectors are added after the reference codes, then ids are put back in query-first order
+            nr=dM_r.ntotal
+            index = faiss.clone_index(dM_r)
+            index.add(dM)
+            D, I = index.search(dM, 2)
+            I=np.where(I>=nr, I-nr, I+nq)
         vv=np.where((D[0:nq,1]<=thr))[0]
         flagL=np.array(flagL)
         vv0=np.where((D[0:nq,1]>thr) & (flagL>0))[0]
@@ -162,15 +191,41 @@ def MakeQuery(qFile, rData=[],dbFile=None, Vgene=True, thr=7, ST=3, thr_s=3.3):
                     _=g.write(line2)
                     curList.append(tup2)
     g.close()
-    cmd='python3 GIANA4.py -f tmp_query.txt -S '+str(thr_s)
+    cmd='python3 GIANA4.py -f tmp_query.txt -C -S '+str(thr_s)
     p=sp.run(cmd, shell=True)
 
+def ReadClusterTable(clusterFile, keys=None):
+    ## Cluster output file as a table without header: CDR3, cluster id, then one column per information field
+    ## The columnar file written with -C is used when present and up to date. With keys, only the clusters having a row
+    ## whose CDR3+'_'+first information field is in keys are kept, and only their information fields are parsed.
+    D=LoadClusterColumns(clusterFile, ['CDR3','cluster','info'])
+    if D is None:
+        return pd.read_table(clusterFile, skiprows=2, delimiter='\t', header=None)
+    seqs=D['CDR3']
+    ids=D['cluster']
+    infos=D['info']
+    if keys is not None:
+        keys=set(keys)
+        ## rows with a CDR3 in keys first, then their full keys
+        cdr3s=set([x.split('_',1)[0] for x in keys])
+        hit=[ii for ii, x in enumerate(seqs) if x in cdr3s]
+        hit=[ii for ii in hit if seqs[ii]+'_'+infos[ii].split('\t',1)[0] in keys]
+        rows=np.where(np.isin(ids, ids[hit]))[0].tolist()
+        seqs=[seqs[ii] for ii in rows]
+        ids=ids[rows]
+        infos=[infos[ii] for ii in rows]
+    T=pd.DataFrame({0:seqs, 1:ids})
+    if len(infos)>0:
+        info=pd.read_table(io.StringIO('\n'.join(infos)), delimiter='\t', header=None, skip_blank_lines=False)
+        info.columns=range(2, info.shape[1]+2)
+        T=pd.concat((T, info), axis=1)
+    return T
+
 def MergeExist(refClusterFile, outFile='queryFinal.txt',queryClusterFile='tmp_query--RotationEncodingBL62.txt', direction='q'):
     ## This function compare the query file with ref cluster file and merge the two based on shared TCRs
     ## If direction is 'q', the overlapping clusters will be added to the query file
     ## If direction is 'r', the overlapping and non-overlapping clusters will be added to the reference file
-    refT=pd.read_table(refClusterFile, skiprows=2, delimiter='\t', header=None)
-    queryT=pd.read_table(queryClusterFile, skiprows=2, delimiter='\t', header=None)
+    queryT=ReadClusterTable(queryClusterFile)
     gn=np.unique(queryT[1])
     queryTs=pd.DataFrame([], columns=queryT.columns)
     for nn in gn:
@@ -181,10 +236,12 @@ def MergeExist(refClusterFile, outFile='queryFinal.txt',queryClusterFile='tmp_qu
                     continue
             queryTs=queryTs.append(tmp_ddq)
     queryTs.index=range(queryTs.shape[0])
-    keyr=refT[0]+'_'+refT[2]
     keyq=queryTs[0]+'_'+queryTs[2]
     nq=queryTs.shape[1]
     vvr=np.where(queryTs[nq-1]=='ref')[0]
+    ## only reference clusters sharing a TCR with the query are used
+    refT=ReadClusterTable(refClusterFile, keys=keyq[vvr])
+    keyr=refT[0]+'_'+refT[2]
     vvr_in=np.where(keyr.isin(keyq[vvr]))[0]
     gn_r=list(refT.loc[vvr_in,1].drop_duplicates())
     ddo=pd.DataFrame([], columns=refT.columns)